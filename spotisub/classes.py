@@ -1,4 +1,7 @@
 """Spotisub classes"""
+import collections
+import threading
+import time
 
 from spotisub import configuration_db, login
 from flask_login import UserMixin
@@ -7,13 +10,110 @@ from werkzeug.security import generate_password_hash, check_password_hash
 
 class ComparisonHelper:
     def __init__(self, track, artist_spotify, found,
-                 excluded, song_ids, track_helper):
+                 excluded, song_ids, track_helper, candidates=None,
+                 prior_match=None, search_results=None,
+                 match_stats=None):
         self.track = track
         self.artist_spotify = artist_spotify
         self.found = found
         self.excluded = excluded
         self.song_ids = song_ids
         self.track_helper = track_helper
+        self.candidates = candidates
+        self.prior_match = prior_match
+        self.search_results = search_results
+        self.match_stats = match_stats
+        self.matched_songs = []
+        self.excluded_songs = []
+        self.skipped_songs = []
+        self.song_artists = {}
+        self.searched_library = False
+
+
+class SearchMemo:
+    """Subsonic search responses memoized during a run,
+    the least recently used ones are evicted past max_responses"""
+
+    def __init__(self, max_responses):
+        self.responses = collections.OrderedDict()
+        self.max_responses = max_responses
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def get(self, query):
+        """get a memoized response, None if missing"""
+        with self.lock:
+            if query not in self.responses:
+                return None
+            self.responses.move_to_end(query)
+            self.hits = self.hits + 1
+            return self.responses[query]
+
+    def put(self, query, songs):
+        """memoize a response, evicting the least recently used one"""
+        with self.lock:
+            self.responses[query] = songs
+            self.responses.move_to_end(query)
+            while len(self.responses) > self.max_responses:
+                self.responses.popitem(last=False)
+
+
+class TokenBucket:
+    """Token bucket rate limiter, halving its rate when throttled
+    and growing back on successful requests"""
+
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.throttled_requests = 0
+        self.wait_seconds = 0.0
+        self.retry_after_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """wait until a request is allowed"""
+        with self.lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            wait = (self.updated - now) + max(0, 1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.requests += 1
+            self.wait_seconds += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeed(self):
+        """grow the rate back after a successful request"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def backoff(self, retry_after):
+        """pause every request for retry_after seconds and halve the rate"""
+        with self.lock:
+            self.throttled_requests += 1
+            self.retry_after_seconds += retry_after
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            self.tokens = 0
+            self.updated = max(self.updated, time.monotonic() + retry_after)
+
+    def get_metrics(self):
+        """get usage and throttling counters"""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "throttled_requests": self.throttled_requests,
+                "rate": round(self.rate, 2),
+                "max_rate": self.max_rate,
+                "wait_seconds": round(self.wait_seconds, 2),
+                "retry_after_seconds": round(self.retry_after_seconds, 2)}
 
 
 @login.user_loader
@@ -4,7 +4,10 @@ SPLIT_TOKENS = ["(", "-", "feat"]
 
 # Configuration constants
 ARTIST_GEN_SCHED = "ARTIST_GEN_SCHED"
+ARTIST_SCOPED_MATCHING = "ARTIST_SCOPED_MATCHING"
 ARTIST_TOP_GEN_SCHED = "ARTIST_GEN_SCHED"
+BATCH_MATCHING_ENABLED = "BATCH_MATCHING_ENABLED"
+BATCH_MATCHING_MIN_SCORE = "BATCH_MATCHING_MIN_SCORE"
 EXCLUDED_WORDS = "EXCLUDED_WORDS"
 ITEMS_PER_PLAYLIST = "ITEMS_PER_PLAYLIST"
 LIDARR_BASE_API_PATH = "LIDARR_BASE_API_PATH"
@@ -13,15 +16,27 @@ LIDARR_IP = "LIDARR_IP"
 LIDARR_PORT = "LIDARR_PORT"
 LIDARR_TOKEN = "LIDARR_TOKEN"
 LIDARR_USE_SSL = "LIDARR_USE_SSL"
+LIBRARY_INDEX_SCHED = "LIBRARY_INDEX_SCHED"
+MATCHING_BACKEND = "MATCHING_BACKEND"
+MATCHING_WORKERS = "MATCHING_WORKERS"
 LOG_LEVEL = "LOG_LEVEL"
+MUSICBRAINZ_CACHE_TTL = "MUSICBRAINZ_CACHE_TTL"
+MUSICBRAINZ_NEGATIVE_CACHE_TTL = "MUSICBRAINZ_NEGATIVE_CACHE_TTL"
+MUSICBRAINZ_WARMUP_SCHED = "MUSICBRAINZ_WARMUP_SCHED"
+NEGATIVE_MATCH_CACHE_TTL = "NEGATIVE_MATCH_CACHE_TTL"
 NUM_USER_PLAYLISTS = "NUM_USER_PLAYLISTS"
+PLAYLIST_FLUSH_EVERY = "PLAYLIST_FLUSH_EVERY"
 PLAYLIST_GEN_SCHED = "PLAYLIST_GEN_SCHED"
 PLAYLIST_PREFIX = "PLAYLIST_PREFIX"
+PLAYLIST_SYNC_MODE = "PLAYLIST_SYNC_MODE"
+PRIOR_MATCH_REVALIDATE_DAYS = "PRIOR_MATCH_REVALIDATE_DAYS"
 RECOMEND_GEN_SCHED = "RECOMEND_GEN_SCHED"
 SAVED_GEN_SCHED = "SAVED_GEN_SCHED"
 SCHEDULER_ENABLED = "SCHEDULER_ENABLED"
 SPOTDL_ENABLED = "SPOTDL_ENABLED"
 SPOTDL_FORMAT = "SPOTDL_FORMAT"
+SPOTIFY_RATE_BURST = "SPOTIFY_RATE_BURST"
+SPOTIFY_RATE_LIMIT = "SPOTIFY_RATE_LIMIT"
 SPOTIPY_CLIENT_ID = "SPOTIPY_CLIENT_ID"
 SPOTIPY_CLIENT_SECRET = "SPOTIPY_CLIENT_SECRET"
 SPOTIPY_REDIRECT_URI = "SPOTIPY_REDIRECT_URI"
@@ -33,21 +48,38 @@ SUBSONIC_API_PORT = "SUBSONIC_API_PORT"
 
 # Default configuration values constants
 ARTIST_GEN_SCHED_DEFAULT_VALUE = "1"
+ARTIST_SCOPED_MATCHING_DEFAULT_VALUE = "1"
 ARTIST_TOP_GEN_SCHED_DEFAULT_VALUE = "1"
+BATCH_MATCHING_ENABLED_DEFAULT_VALUE = "0"
+BATCH_MATCHING_MIN_SCORE_DEFAULT_VALUE = "0.5"
 EXCLUDED_WORDS_DEFAULT_VALUE = "acoustic,instrumental,demo"
 ITEMS_PER_PLAYLIST_DEFAULT_VALUE = "1000"
 LIDARR_BASE_API_PATH_DEFAULT_VALUE = ""
 LIDARR_ENABLED_DEFAULT_VALUE = "0"
 LIDARR_USE_SSL_DEFAULT_VALUE = "0"
+LIBRARY_INDEX_SCHED_DEFAULT_VALUE = "1"
+# "process" forks a pool per playlist, so it needs a plain (non eventlet)
+# server: under gunicorn -k eventlet it falls back to "thread"
+MATCHING_BACKEND_DEFAULT_VALUE = "thread"
+MATCHING_WORKERS_DEFAULT_VALUE = "4"
 LOG_LEVEL_DEFAULT_VALUE = "40"
+MUSICBRAINZ_CACHE_TTL_DEFAULT_VALUE = "30"
+MUSICBRAINZ_NEGATIVE_CACHE_TTL_DEFAULT_VALUE = "7"
+MUSICBRAINZ_WARMUP_SCHED_DEFAULT_VALUE = "24"
+NEGATIVE_MATCH_CACHE_TTL_DEFAULT_VALUE = "7"
 NUM_USER_PLAYLISTS_DEFAULT_VALUE = "5"
+PLAYLIST_FLUSH_EVERY_DEFAULT_VALUE = "0"
 PLAYLIST_GEN_SCHED_DEFAULT_VALUE = "3"
 PLAYLIST_PREFIX_DEFAULT_VALUE = "Spotisub - "
+PLAYLIST_SYNC_MODE_DEFAULT_VALUE = "diff"
+PRIOR_MATCH_REVALIDATE_DAYS_DEFAULT_VALUE = "7"
 RECOMEND_GEN_SCHED_DEFAULT_VALUE = "4"
 SAVED_GEN_SCHED_DEFAULT_VALUE = "2"
 SCHEDULER_ENABLED_DEFAULT_VALUE = "1"
 SPOTDL_ENABLED_DEFAULT_VALUE = "0"
 SPOTDL_FORMAT_DEFAULT_VALUE = "/music/{artist}/{artists} - {album} ({year}) - {track-number} - {title}.{output-ext}"
+SPOTIFY_RATE_BURST_DEFAULT_VALUE = "20"
+SPOTIFY_RATE_LIMIT_DEFAULT_VALUE = "10"
 SPOTIPY_CLIENT_ID_DEFAULT_VALUE = ""
 SPOTIPY_CLIENT_SECRET_DEFAULT_VALUE = ""
 SPOTIPY_REDIRECT_URI_DEFAULT_VALUE = "http://127.0.0.1:8080/"
@@ -60,3 +92,5 @@ JOB_ATT_ID = 'artist_top_tracks'
 JOB_MR_ID = 'my_recommendations'
 JOB_UP_ID = 'user_playlists'
 JOB_ST_ID = 'saved_tracks'
+JOB_LI_ID = 'library_index'
+JOB_MW_ID = 'musicbrainz_warmup'
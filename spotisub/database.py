@@ -13,14 +13,17 @@ from sqlalchemy import Table
 from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import Text
 from sqlalchemy import MetaData
 from sqlalchemy import DateTime
 from sqlalchemy import func
 from sqlalchemy import text
 from sqlalchemy import desc
 from sqlalchemy import or_
+from sqlalchemy import and_
 from sqlalchemy import distinct
 from sqlalchemy import collate
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 VERSION = "0.3.3"
 VERSIONS = ["0.3.0-alpha-01", "0.3.1", "0.3.3"]
@@ -34,6 +37,13 @@ SPOTIFY_SONG = 'spotify_song'
 SPOTIFY_ARTIST = 'spotify_artist'
 SPOTIFY_ALBUM = 'spotify_album'
 SPOTIFY_SONG_ARTIST_RELATION = 'spotify_song_artist_relation'
+SUBSONIC_ISRC_INDEX = 'subsonic_isrc_index'
+MUSICBRAINZ_RECORDING_CACHE = 'musicbrainz_recording_cache'
+NEGATIVE_MATCH_CACHE = 'negative_match_cache'
+SPOTIFY_OBJECT_CACHE = 'spotify_object_cache'
+
+# stay below the sqlite bound parameters limit
+SQL_IN_CHUNK_SIZE = 500
 
 
 class Database:
@@ -72,7 +82,8 @@ class Database:
                 'subsonic_artist_id', String(36), nullable=True), Column(
                     'spotify_song_uuid', String(36), nullable=True), Column(
                         'playlist_info_uuid', String(36), nullable=False), Column(
-            'ignored', Integer, nullable=False, default=0))
+            'ignored', Integer, nullable=False, default=0), Column(
+            'last_verified', DateTime(timezone=True), nullable=True))
 
     playlist_info = Table(
         PLAYLIST_INFO, metadata, Column(
@@ -83,7 +94,9 @@ class Database:
                         'import_arg', String(500), nullable=False), Column(
                             'prefix', String(500), nullable=False), Column(
                                 'type', String(36), nullable=False), Column(
-            'ignored', Integer, nullable=False, default=0))
+            'ignored', Integer, nullable=False, default=0), Column(
+            'snapshot_id', String(100), nullable=True), Column(
+            'library_version', String(36), nullable=True))
 
     spotify_song = Table(SPOTIFY_SONG, metadata,
                          Column(
@@ -183,11 +196,100 @@ class Database:
                               'ignored', Integer, nullable=False, default=0)
                           )
 
+    subsonic_isrc_index = Table(SUBSONIC_ISRC_INDEX, metadata,
+                                Column(
+                                    'uuid',
+                                    String(36),
+                                    primary_key=True,
+                                    nullable=False),
+                                Column(
+                                    'isrc',
+                                    String(36),
+                                    index=True,
+                                    nullable=False),
+                                Column(
+                                    'subsonic_song_id',
+                                    String(36),
+                                    index=True,
+                                    nullable=False),
+                                Column(
+                                    'musicbrainz_id', String(36), nullable=True),
+                                Column(
+                                    'last_verified',
+                                    DateTime(
+                                        timezone=True),
+                                    server_default=func.now(),
+                                    nullable=False)
+                                )
+
+    musicbrainz_recording_cache = Table(MUSICBRAINZ_RECORDING_CACHE, metadata,
+                                        Column(
+                                            'musicbrainz_id',
+                                            String(36),
+                                            primary_key=True,
+                                            nullable=False),
+                                        Column(
+                                            'isrc_list', String(500), nullable=False),
+                                        Column(
+                                            'found', Integer, nullable=False, default=0),
+                                        Column(
+                                            'tms_update',
+                                            DateTime(
+                                                timezone=True),
+                                            server_default=func.now(),
+                                            onupdate=func.now(),
+                                            nullable=False)
+                                        )
+
+    negative_match_cache = Table(NEGATIVE_MATCH_CACHE, metadata,
+                                 Column(
+                                     'spotify_uri',
+                                     String(500),
+                                     primary_key=True,
+                                     nullable=False),
+                                 Column(
+                                     'library_version', String(36), nullable=False),
+                                 Column(
+                                     'tms_update',
+                                     DateTime(
+                                         timezone=True),
+                                     server_default=func.now(),
+                                     onupdate=func.now(),
+                                     nullable=False)
+                                 )
+
+    spotify_object_cache = Table(SPOTIFY_OBJECT_CACHE, metadata,
+                                 Column(
+                                     'spotify_uri',
+                                     String(500),
+                                     primary_key=True,
+                                     nullable=False),
+                                 Column(
+                                     'spotify_object', Text, nullable=False),
+                                 Column(
+                                     'tms_expire',
+                                     DateTime(
+                                         timezone=True),
+                                     index=True,
+                                     nullable=False)
+                                 )
+
 
 def create_db_tables():
     """Create tables"""
     dbms.metadata.create_all(dbms.db_engine)
     upgrade()
+    upgrade_columns()
+
+
+def upgrade_columns():
+    """Add columns introduced after the tables were created"""
+    with dbms.db_engine.connect() as conn:
+        add_column(conn, SUBSONIC_SPOTIFY_RELATION, 'last_verified', 'DATETIME')
+        add_column(conn, PLAYLIST_INFO, 'snapshot_id', 'VARCHAR(100)')
+        add_column(conn, PLAYLIST_INFO, 'library_version', 'VARCHAR(36)')
+        conn.commit()
+        conn.close()
 
 
 def upgrade():
@@ -251,6 +353,23 @@ def check_table(conn, table_name):
     return count
 
 
+def check_column(conn, table_name, column_name):
+    """Check if a column exists"""
+    query_check = "SELECT count(name) FROM pragma_table_info('" + \
+        table_name + "') WHERE name='" + column_name + "'"
+    count = conn.execute(text(query_check)).scalar()
+    return count
+
+
+def add_column(conn, table_name, column_name, column_type):
+    """Add single column if missing"""
+    if check_table(conn, table_name) == 1 and check_column(
+            conn, table_name, column_name) == 0:
+        query = "ALTER TABLE " + table_name + " ADD COLUMN " + \
+            column_name + " " + column_type
+        conn.execute(text(query))
+
+
 def clone_table_from_bak(conn, table_name):
     """Clone table from bak"""
     if check_table(conn, table_name) == 1:
@@ -278,8 +397,9 @@ def user_exists():
 
 
 def insert_song(playlist_info, subsonic_track,
-                artist_spotify, track_spotify):
-    """Create empty playlist into database"""
+                artist_spotify, track_spotify, verified=True):
+    """Create empty playlist into database,
+    verified is False when a previous match is reused without checking it"""
     return_dict = None
     with dbms.db_engine.connect() as conn:
         pl_info = insert_playlist_type(
@@ -305,7 +425,8 @@ def insert_song(playlist_info, subsonic_track,
                         artist_id,
                         playlist_info,
                         return_dict["song_uuid"],
-                        pl_info.uuid)
+                        pl_info.uuid,
+                        verified=verified)
 
                 if pl_relation is not None:
                     return_dict["uuid"] = pl_relation.uuid
@@ -552,7 +673,9 @@ def select_playlist_info_by_uuid(uuid):
             dbms.playlist_info.c.spotify_playlist_uri,
             dbms.playlist_info.c.ignored,
             dbms.playlist_info.c.type,
-            dbms.playlist_info.c.import_arg).where(
+            dbms.playlist_info.c.import_arg,
+            dbms.playlist_info.c.snapshot_id,
+            dbms.playlist_info.c.library_version).where(
             dbms.playlist_info.c.uuid == uuid)
         stmt.compile()
         cursor = conn.execute(stmt)
@@ -575,7 +698,9 @@ def select_playlist_info_by_uuid_with_conn(conn, uuid):
         dbms.playlist_info.c.spotify_playlist_uri,
         dbms.playlist_info.c.ignored,
         dbms.playlist_info  .c.type,
-        dbms.playlist_info.c.import_arg).where(
+        dbms.playlist_info.c.import_arg,
+        dbms.playlist_info.c.snapshot_id,
+        dbms.playlist_info.c.library_version).where(
         dbms.playlist_info.c.uuid == uuid)
     stmt.compile()
     cursor = conn.execute(stmt)
@@ -633,7 +758,8 @@ def insert_playlist_relation(
         subsonic_artist_id,
         playlist_info,
         spotify_song_uuid,
-        pl_info_uuid):
+        pl_info_uuid,
+        verified=True):
     """insert playlist into database"""
     old_relation = select_playlist_relation(
         conn,
@@ -641,6 +767,7 @@ def insert_playlist_relation(
         subsonic_artist_id,
         spotify_song_uuid,
         pl_info_uuid)
+    last_verified = func.now() if subsonic_song_id is not None and verified else None
     if old_relation is None:
         stmt = insert(
             dbms.subsonic_spotify_relation).values(
@@ -648,7 +775,8 @@ def insert_playlist_relation(
             subsonic_song_id=subsonic_song_id,
             subsonic_artist_id=subsonic_artist_id,
             spotify_song_uuid=spotify_song_uuid,
-            playlist_info_uuid=pl_info_uuid)
+            playlist_info_uuid=pl_info_uuid,
+            last_verified=last_verified)
         stmt.compile()
         conn.execute(stmt)
         return select_playlist_relation(
@@ -665,6 +793,9 @@ def insert_playlist_relation(
             subsonic_song_id=subsonic_song_id,
             subsonic_artist_id=subsonic_artist_id,
             spotify_song_uuid=spotify_song_uuid)
+        if verified or subsonic_song_id is None:
+            # a reused match must not renew its own freshness
+            stmt = stmt.values(last_verified=last_verified)
         stmt.compile()
         conn.execute(stmt)
         return select_playlist_relation_by_uuid(old_relation.uuid)
@@ -1628,5 +1759,325 @@ def update_ignored_playlist(uuid, value):
         conn.close()
 
 
+def update_playlist_snapshot(uuid, snapshot_id, library_version):
+    """store the spotify snapshot and library version a playlist was synced at"""
+    with dbms.db_engine.connect() as conn:
+        stmt = update(
+            dbms.playlist_info).where(
+            dbms.playlist_info.c.uuid == uuid).values(
+            snapshot_id=snapshot_id,
+            library_version=library_version)
+
+        stmt.compile()
+        conn.execute(stmt)
+        conn.commit()
+        conn.close()
+
+
+def insert_isrcs(isrc_songs):
+    """insert or refresh isrc -> subsonic song rows"""
+    with dbms.db_engine.connect() as conn:
+        for isrc_song in isrc_songs:
+            insert_isrc(
+                conn,
+                isrc_song["isrc"],
+                isrc_song["subsonic_song_id"],
+                isrc_song["musicbrainz_id"])
+        conn.commit()
+        conn.close()
+
+
+def insert_isrc(conn, isrc, subsonic_song_id, musicbrainz_id):
+    """insert or refresh a single isrc -> subsonic song row"""
+    isrc = isrc.strip().upper()
+    old_isrc = select_isrc(conn, isrc, subsonic_song_id)
+    if old_isrc is None:
+        stmt = insert(
+            dbms.subsonic_isrc_index).values(
+            uuid=str(uuid.uuid4().hex),
+            isrc=isrc,
+            subsonic_song_id=subsonic_song_id,
+            musicbrainz_id=musicbrainz_id)
+    else:
+        stmt = update(
+            dbms.subsonic_isrc_index).where(
+            dbms.subsonic_isrc_index.c.uuid == old_isrc.uuid).values(
+            musicbrainz_id=musicbrainz_id,
+            last_verified=func.now())
+    stmt.compile()
+    conn.execute(stmt)
+
+
+def select_isrc(conn, isrc, subsonic_song_id):
+    """select isrc row by isrc and subsonic song id"""
+    value = None
+    stmt = select(
+        dbms.subsonic_isrc_index.c.uuid,
+        dbms.subsonic_isrc_index.c.isrc,
+        dbms.subsonic_isrc_index.c.subsonic_song_id,
+        dbms.subsonic_isrc_index.c.musicbrainz_id,
+        dbms.subsonic_isrc_index.c.last_verified).where(
+        dbms.subsonic_isrc_index.c.isrc == isrc,
+        dbms.subsonic_isrc_index.c.subsonic_song_id == subsonic_song_id)
+    stmt.compile()
+    cursor = conn.execute(stmt)
+    records = cursor.fetchall()
+
+    for row in records:
+        value = row
+    cursor.close()
+
+    return value
+
+
+def select_subsonic_song_ids_by_isrc(isrc):
+    """select subsonic song ids by isrc"""
+    song_ids = []
+    with dbms.db_engine.connect() as conn:
+        stmt = select(
+            dbms.subsonic_isrc_index.c.subsonic_song_id).where(
+            dbms.subsonic_isrc_index.c.isrc == isrc.strip().upper())
+        stmt.compile()
+        cursor = conn.execute(stmt)
+        records = cursor.fetchall()
+
+        for row in records:
+            song_ids.append(row.subsonic_song_id)
+        cursor.close()
+        conn.close()
+
+    return song_ids
+
+
+def select_indexed_isrcs(isrcs):
+    """select which of the isrcs have at least one subsonic song"""
+    indexed_isrcs = set()
+    isrcs = list(dict.fromkeys(isrc.strip().upper() for isrc in isrcs))
+    with dbms.db_engine.connect() as conn:
+        for chunk in range(0, len(isrcs), SQL_IN_CHUNK_SIZE):
+            stmt = select(
+                dbms.subsonic_isrc_index.c.isrc).where(
+                dbms.subsonic_isrc_index.c.isrc.in_(
+                    isrcs[chunk:chunk + SQL_IN_CHUNK_SIZE])).distinct()
+            stmt.compile()
+            cursor = conn.execute(stmt)
+            records = cursor.fetchall()
+
+            for row in records:
+                indexed_isrcs.add(row.isrc)
+            cursor.close()
+        conn.close()
+
+    return indexed_isrcs
+
+
+def delete_isrc_by_subsonic_song_id(subsonic_song_id):
+    """delete isrc rows pointing to a subsonic song"""
+    with dbms.db_engine.connect() as conn:
+        stmt = delete(dbms.subsonic_isrc_index).where(
+            dbms.subsonic_isrc_index.c.subsonic_song_id == subsonic_song_id)
+        stmt.compile()
+        conn.execute(stmt)
+        conn.commit()
+        conn.close()
+
+
+def select_musicbrainz_recording(musicbrainz_id, ttl_days, negative_ttl_days):
+    """select a not expired musicbrainz recording from cache"""
+    value = None
+    with dbms.db_engine.connect() as conn:
+        stmt = select(
+            dbms.musicbrainz_recording_cache.c.musicbrainz_id,
+            dbms.musicbrainz_recording_cache.c.isrc_list,
+            dbms.musicbrainz_recording_cache.c.found).where(
+            dbms.musicbrainz_recording_cache.c.musicbrainz_id == musicbrainz_id,
+            or_(
+                and_(
+                    dbms.musicbrainz_recording_cache.c.found == 1,
+                    dbms.musicbrainz_recording_cache.c.tms_update > func.datetime(
+                        'now', '-' + str(ttl_days) + ' days')),
+                and_(
+                    dbms.musicbrainz_recording_cache.c.found == 0,
+                    dbms.musicbrainz_recording_cache.c.tms_update > func.datetime(
+                        'now', '-' + str(negative_ttl_days) + ' days'))))
+        stmt.compile()
+        cursor = conn.execute(stmt)
+        records = cursor.fetchall()
+
+        for row in records:
+            value = row
+        cursor.close()
+        conn.close()
+
+    return value
+
+
+def insert_or_update_musicbrainz_recording(musicbrainz_id, isrc_list):
+    """cache musicbrainz recording isrcs, an empty list is a negative entry"""
+    with dbms.db_engine.connect() as conn:
+        stmt = select(
+            dbms.musicbrainz_recording_cache.c.musicbrainz_id).where(
+            dbms.musicbrainz_recording_cache.c.musicbrainz_id == musicbrainz_id)
+        stmt.compile()
+        old_recording = conn.execute(stmt).first()
+        if old_recording is None:
+            stmt = insert(
+                dbms.musicbrainz_recording_cache).values(
+                musicbrainz_id=musicbrainz_id,
+                isrc_list=",".join(isrc_list),
+                found=1 if len(isrc_list) > 0 else 0)
+        else:
+            stmt = update(
+                dbms.musicbrainz_recording_cache).where(
+                dbms.musicbrainz_recording_cache.c.musicbrainz_id == musicbrainz_id).values(
+                isrc_list=",".join(isrc_list),
+                found=1 if len(isrc_list) > 0 else 0,
+                tms_update=func.now())
+        stmt.compile()
+        conn.execute(stmt)
+        conn.commit()
+        conn.close()
+
+
+def select_prior_matches(spotify_uris, revalidate_days):
+    """select the last subsonic song matched to each spotify uri,
+    fresh is 1 when it was verified less than revalidate_days ago"""
+    prior_matches = {}
+    with dbms.db_engine.connect() as conn:
+        for chunk in range(0, len(spotify_uris), SQL_IN_CHUNK_SIZE):
+            stmt = select(
+                dbms.spotify_song.c.spotify_uri,
+                dbms.subsonic_spotify_relation.c.subsonic_song_id,
+                dbms.subsonic_spotify_relation.c.subsonic_artist_id,
+                dbms.subsonic_spotify_relation.c.last_verified,
+                func.coalesce(
+                    dbms.subsonic_spotify_relation.c.last_verified > func.datetime(
+                        'now', '-' + str(revalidate_days) + ' days'), 0).label('fresh')).join(
+                dbms.subsonic_spotify_relation,
+                dbms.subsonic_spotify_relation.c.spotify_song_uuid == dbms.spotify_song.c.uuid).where(
+                dbms.spotify_song.c.spotify_uri.in_(
+                    spotify_uris[chunk:chunk + SQL_IN_CHUNK_SIZE]),
+                dbms.subsonic_spotify_relation.c.subsonic_song_id.isnot(None)).order_by(
+                dbms.subsonic_spotify_relation.c.last_verified)
+            stmt.compile()
+            cursor = conn.execute(stmt)
+            records = cursor.fetchall()
+
+            # most recently verified row wins, nulls sort first
+            for row in records:
+                prior_matches[row.spotify_uri] = row
+            cursor.close()
+        conn.close()
+
+    return prior_matches
+
+
+def select_negative_matches(spotify_uris, library_version, ttl_days):
+    """select spotify uris not found in this library version and not expired"""
+    negative_matches = set()
+    with dbms.db_engine.connect() as conn:
+        for chunk in range(0, len(spotify_uris), SQL_IN_CHUNK_SIZE):
+            stmt = select(
+                dbms.negative_match_cache.c.spotify_uri).where(
+                dbms.negative_match_cache.c.spotify_uri.in_(
+                    spotify_uris[chunk:chunk + SQL_IN_CHUNK_SIZE]),
+                dbms.negative_match_cache.c.library_version == library_version,
+                dbms.negative_match_cache.c.tms_update > func.datetime(
+                    'now', '-' + str(ttl_days) + ' days'))
+            stmt.compile()
+            cursor = conn.execute(stmt)
+            records = cursor.fetchall()
+
+            for row in records:
+                negative_matches.add(row.spotify_uri)
+            cursor.close()
+        conn.close()
+
+    return negative_matches
+
+
+def insert_or_update_negative_matches(spotify_uris, library_version):
+    """record spotify uris searched and not found in this library version"""
+    spotify_uris = list(dict.fromkeys(spotify_uris))
+    with dbms.db_engine.connect() as conn:
+        for chunk in range(0, len(spotify_uris), SQL_IN_CHUNK_SIZE):
+            stmt = delete(dbms.negative_match_cache).where(
+                dbms.negative_match_cache.c.spotify_uri.in_(
+                    spotify_uris[chunk:chunk + SQL_IN_CHUNK_SIZE]))
+            stmt.compile()
+            conn.execute(stmt)
+        if len(spotify_uris) > 0:
+            stmt = insert(dbms.negative_match_cache)
+            conn.execute(stmt, [{"spotify_uri": spotify_uri,
+                                 "library_version": library_version}
+                                for spotify_uri in spotify_uris])
+        conn.commit()
+        conn.close()
+
+
+def select_spotify_object(spotify_uri):
+    """select a not expired spotify object json from cache"""
+    return select_spotify_objects([spotify_uri]).get(spotify_uri)
+
+
+def select_spotify_objects(spotify_uris):
+    """select not expired spotify objects json from cache, by uri"""
+    spotify_objects = {}
+    with dbms.db_engine.connect() as conn:
+        for chunk in range(0, len(spotify_uris), SQL_IN_CHUNK_SIZE):
+            stmt = select(
+                dbms.spotify_object_cache.c.spotify_uri,
+                dbms.spotify_object_cache.c.spotify_object).where(
+                dbms.spotify_object_cache.c.spotify_uri.in_(
+                    spotify_uris[chunk:chunk + SQL_IN_CHUNK_SIZE]),
+                dbms.spotify_object_cache.c.tms_expire > func.datetime('now'))
+            stmt.compile()
+            cursor = conn.execute(stmt)
+            records = cursor.fetchall()
+
+            for row in records:
+                spotify_objects[row.spotify_uri] = row.spotify_object
+            cursor.close()
+        conn.close()
+
+    return spotify_objects
+
+
+def insert_or_update_spotify_object(spotify_uri, spotify_object, ttl_seconds):
+    """cache a spotify object json, expiring after ttl_seconds"""
+    insert_or_update_spotify_objects({spotify_uri: spotify_object}, ttl_seconds)
+
+
+def insert_or_update_spotify_objects(spotify_objects, ttl_seconds):
+    """cache spotify objects json by uri, expiring after ttl_seconds"""
+    tms_expire = func.datetime('now', '%+d seconds' % ttl_seconds)
+    with dbms.db_engine.connect() as conn:
+        for spotify_uri, spotify_object in spotify_objects.items():
+            stmt = sqlite_insert(
+                dbms.spotify_object_cache).values(
+                spotify_uri=spotify_uri,
+                spotify_object=spotify_object,
+                tms_expire=tms_expire)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[dbms.spotify_object_cache.c.spotify_uri],
+                set_={"spotify_object": spotify_object,
+                      "tms_expire": tms_expire})
+            stmt.compile()
+            conn.execute(stmt)
+        conn.commit()
+        conn.close()
+
+
+def delete_expired_spotify_objects():
+    """delete expired spotify objects from cache"""
+    with dbms.db_engine.connect() as conn:
+        stmt = delete(dbms.spotify_object_cache).where(
+            dbms.spotify_object_cache.c.tms_expire <= func.datetime('now'))
+        stmt.compile()
+        conn.execute(stmt)
+        conn.commit()
+        conn.close()
+
+
 dbms = Database(SQLITE, dbname=Config.SQLALCHEMY_DATABASE_NAME)
 create_db_tables()
@@ -2,7 +2,6 @@
 import logging
 import os
 import random
-import time
 import re
 import string
 import math
@@ -78,12 +77,9 @@ def scan_user_saved_tracks():
     subsonic_helper.generate_playlist(playlist_info)
 
 
-def scan_user_playlists(offset=0):
+def scan_user_playlists():
     """get list of user playlists"""
-    sp = spotipy_helper.get_spotipy_client()
-    playlist_result = sp.current_user_playlists(limit=50, offset=offset)
-
-    for item in playlist_result['items']:
+    for item in get_user_playlists_items():
         if item['name'] is not None and item['name'].strip() != '':
             playlist_info = {}
             playlist_info["name"] = item['name'].strip()
@@ -92,10 +88,6 @@ def scan_user_playlists(offset=0):
             playlist_info["import_arg"] = item['name']
             subsonic_helper.generate_playlist(playlist_info)
 
-    if len(playlist_result['items']) != 0:
-        scan_user_playlists(offset=offset + 50)
-    return
-
 
 def init_artists_top_tracks():
     """all artists top tracks"""
@@ -351,15 +343,12 @@ def my_recommendations_run(uuid):
             limit=50, time_range='long_term')
         logging.info('(%s) Loaded your custom top tracks',
                      str(threading.current_thread().ident))
-        time.sleep(2)
         liked_tracks = sp.current_user_saved_tracks(limit=50)
         logging.info('(%s) Loaded your top liked tracks',
                      str(threading.current_thread().ident))
-        time.sleep(2)
         history = sp.current_user_recently_played(limit=50)
         logging.info('(%s) Loaded your played tracks',
                      str(threading.current_thread().ident))
-        time.sleep(2)
         logging.info(
             '(%s) Searching your recommendations (playlist %s)',
             str(threading.current_thread().ident), str(
@@ -448,25 +437,29 @@ def get_user_playlists(uuid):
         logging.info("Skipping thread execution becase a full reimport process is running")
 
 
-def get_user_playlists_run(uuid, offset=0):
-    """get user playlists"""
+def get_user_playlists_run(uuid, force=False):
+    """get user playlists, force imports them even if unchanged"""
     playlist_info_db = database.select_playlist_info_by_uuid(uuid)
     if playlist_info_db is not None and playlist_info_db.uuid is not None:
 
         sp = spotipy_helper.get_spotipy_client()
 
-        playlist_result = sp.current_user_playlists(
-            limit=50, offset=offset)
-
-        for item in playlist_result['items']:
+        for item in get_user_playlists_items():
             if item['name'] is not None and item['name'].strip() != '' and (playlist_info_db.import_arg is None or (
                     playlist_info_db.import_arg is not None and item['name'].lower().strip() == playlist_info_db.import_arg.lower().strip())):
+                if not force and subsonic_helper.is_playlist_unchanged(
+                        playlist_info_db, item.get("snapshot_id")):
+                    logging.info(
+                        '(%s) Skipping playlist %s, nothing changed since the last import',
+                        str(threading.current_thread().ident), item['name'])
+                    continue
                 playlist_info = {}
                 playlist_info["uuid"] = playlist_info_db.uuid
                 playlist_info["name"] = item['name'].strip()
                 playlist_info["spotify_uri"] = item["uri"]
                 playlist_info["type"] = constants.JOB_UP_ID
                 playlist_info["import_arg"] = item['name']
+                playlist_info["snapshot_id"] = item.get("snapshot_id")
                 logging.info(
                     '(%s) Importing playlist: %s', str(
                         threading.current_thread().ident), item['name'])
@@ -474,9 +467,6 @@ def get_user_playlists_run(uuid, offset=0):
                 result = get_playlist_tracks(item, result)
                 subsonic_helper.write_playlist(sp, playlist_info, result)
 
-        if len(playlist_result['items']) != 0:
-            get_user_playlists_run(uuid, offset=offset + 50)
-
     if os.environ.get(constants.PLAYLIST_GEN_SCHED,
                       constants.PLAYLIST_GEN_SCHED_DEFAULT_VALUE) == "0":
         scheduler.remove_job(id=constants.JOB_UP_ID)
@@ -495,13 +485,14 @@ def get_user_playlists_run(uuid, offset=0):
             scheduler.remove_job(id=constants.JOB_UP_ID)
 
 
-def get_user_saved_tracks_playlist(result, offset_tracks=0):
+def get_user_saved_tracks_playlist(result):
     """get user saved tracks playlist"""
     sp = spotipy_helper.get_spotipy_client()
-    response_tracks = sp.current_user_saved_tracks(
-        offset=offset_tracks,
-        limit=50)
-    for track_item in response_tracks['items']:
+    for track_item in spotipy_helper.get_all_items(
+            lambda offset, limit: sp.current_user_saved_tracks(
+                offset=offset,
+                limit=limit),
+            50):
         if "track" in track_item:
             track = track_item['track']
             if track is not None:
@@ -512,10 +503,6 @@ def get_user_saved_tracks_playlist(result, offset_tracks=0):
                     track['name'])
                 if track is not None:
                     result["tracks"].append(track)
-    time.sleep(2)
-    if len(response_tracks['items']) != 0:
-        result = get_user_saved_tracks_playlist(
-            result, offset_tracks=offset_tracks + 50)
     return result
 
 
@@ -529,16 +516,17 @@ def get_artist(name):
     return None
 
 
-def get_playlist_tracks(item, result, offset_tracks=0):
+def get_playlist_tracks(item, result):
     """get playlist tracks"""
     sp = spotipy_helper.get_spotipy_client()
-    response_tracks = sp.playlist_items(
-        item['id'],
-        offset=offset_tracks,
-        fields='items.track.id,items.track.name,items.track.artists,total',
-        limit=50,
-        additional_types=['track'])
-    for track_item in response_tracks['items']:
+    for track_item in spotipy_helper.get_all_items(
+            lambda offset, limit: sp.playlist_items(
+                item['id'],
+                offset=offset,
+                fields='items.track.id,items.track.name,items.track.artists,total',
+                limit=limit,
+                additional_types=['track']),
+            100):
         track = track_item['track']
         logging.info(
             '(%s) Found %s - %s inside playlist %s',
@@ -548,54 +536,43 @@ def get_playlist_tracks(item, result, offset_tracks=0):
             item['name'])
         if track is not None:
             result["tracks"].append(track)
-    time.sleep(2)
-    if len(response_tracks['items']) != 0:
-        result = get_playlist_tracks(
-            item, result, offset_tracks=offset_tracks + 50)
     return result
 
 
-def get_user_playlist_by_name(playlist_name, offset=0):
-    """get user playlist by name"""
+def get_user_playlists_items():
+    """get every playlist of the current user"""
     sp = spotipy_helper.get_spotipy_client()
-    playlist_result = sp.current_user_playlists(limit=50, offset=offset)
+    return spotipy_helper.get_all_items(
+        lambda offset, limit: sp.current_user_playlists(
+            limit=limit, offset=offset),
+        50)
+
 
+def get_user_playlist_by_name(playlist_name):
+    """get user playlist by name"""
     name_found = None
 
-    for item in playlist_result['items']:
+    for item in get_user_playlists_items():
         if (item['name'] is not None and item['name'].strip() != ''
             and (playlist_name is None
             or (playlist_name is not None
                 and item['name'].lower().strip() == playlist_name.lower().strip()))):
             name_found = item['name'].strip()
-    if name_found is None and len(playlist_result['items']) != 0:
-        name_found = get_user_playlist_by_name(
-            playlist_name, offset=offset + 50)
     return name_found
 
 
-def count_user_playlists(count, offset=0):
+def count_user_playlists(count):
     """count user playlists"""
     sp = spotipy_helper.get_spotipy_client()
-    playlist_result = sp.current_user_playlists(limit=50, offset=offset)
-    count = count + len(playlist_result['items'])
-
-    if len(playlist_result['items']) != 0:
-        count = count_user_playlists(count, offset=offset + 50)
-    return count
+    playlist_result = sp.current_user_playlists(limit=1)
+    return count + playlist_result['total']
 
 
-def get_user_playlists_array(array, offset=0):
+def get_user_playlists_array(array):
     """get list of user playlists"""
-    sp = spotipy_helper.get_spotipy_client()
-    playlist_result = sp.current_user_playlists(limit=50, offset=offset)
-
-    for item in playlist_result['items']:
+    for item in get_user_playlists_items():
         if item['name'] is not None and item['name'].strip() != '':
             array.append(item)
-
-    if len(playlist_result['items']) != 0:
-        array = get_user_playlists_array(array, offset=offset + 50)
     return array
 
 
@@ -634,6 +611,8 @@ def reimport(uuid):
                 constants.RECOMEND_GEN_SCHED,
                 constants.RECOMEND_GEN_SCHED_DEFAULT_VALUE)
         elif playlist_info.type == constants.JOB_UP_ID:
+            # a manual rescan always imports the playlist again
+            database.update_playlist_snapshot(uuid, None, None)
             run_job_now(
                 timedelta_sec,
                 get_user_playlists,
@@ -747,11 +726,16 @@ def reimport_all():
 
 def reimport_all_thread():
     """Used to reimport everything"""
-    import_all_user_saved_tracks()
-    import_all_my_recommendations()
-    import_all_user_playlists()
-    import_all_artists_recommendations()
-    import_all_artists_top_tracks()
+    with subsonic_helper.search_memo_scope() as memo:
+        import_all_user_saved_tracks()
+        import_all_my_recommendations()
+        import_all_user_playlists()
+        import_all_artists_recommendations()
+        import_all_artists_top_tracks()
+        logging.info(
+            '(%s) Reimport run summary: %s search cache hits',
+            str(threading.current_thread().ident),
+            memo.hits)
 
 def import_all_user_saved_tracks():
     playlist_infos = database.select_playlist_info_by_type(
@@ -785,7 +769,8 @@ def import_all_user_playlists():
             constants.JOB_UP_ID)
     if len(playlist_infos) > 0:
         for playlist_info in playlist_infos:
-            get_user_playlists_run(playlist_info.uuid)
+            # a full reimport is explicitly asked, unchanged playlists too
+            get_user_playlists_run(playlist_info.uuid, force=True)
 
 
 scheduler.add_job(
@@ -797,6 +782,43 @@ scheduler.add_job(
     max_instances=1
 )
 
+scheduler.add_job(
+    func=database.delete_expired_spotify_objects,
+    trigger="interval",
+    hours=1,
+    id="delete_expired_spotify_objects",
+    replace_existing=True,
+    max_instances=1
+)
+
+if subsonic_helper.is_library_index_enabled():
+    scheduler.add_job(
+        func=subsonic_helper.refresh_library_index,
+        trigger="interval",
+        hours=int(
+            os.environ.get(
+                constants.LIBRARY_INDEX_SCHED,
+                constants.LIBRARY_INDEX_SCHED_DEFAULT_VALUE)),
+        id=constants.JOB_LI_ID,
+        replace_existing=True,
+        max_instances=1
+    )
+
+if (subsonic_helper.is_library_index_enabled()
+        and os.environ.get(constants.MUSICBRAINZ_WARMUP_SCHED,
+                           constants.MUSICBRAINZ_WARMUP_SCHED_DEFAULT_VALUE) != "0"):
+    scheduler.add_job(
+        func=subsonic_helper.warmup_musicbrainz_cache,
+        trigger="interval",
+        hours=int(
+            os.environ.get(
+                constants.MUSICBRAINZ_WARMUP_SCHED,
+                constants.MUSICBRAINZ_WARMUP_SCHED_DEFAULT_VALUE)),
+        id=constants.JOB_MW_ID,
+        replace_existing=True,
+        max_instances=1
+    )
+
 scheduler.add_job(
     func=init_jobs,
     trigger="interval",
@@ -834,3 +856,9 @@ except BaseException:
 
 scheduler.modify_job(id="init_jobs", next_run_time=datetime.now())
 scheduler.modify_job(id="scan_library", next_run_time=datetime.now())
+if subsonic_helper.is_library_index_enabled():
+    scheduler.modify_job(id=constants.JOB_LI_ID, next_run_time=datetime.now())
+if scheduler.get_job(constants.JOB_MW_ID) is not None:
+    scheduler.modify_job(
+        id=constants.JOB_MW_ID,
+        next_run_time=datetime.now() + timedelta(minutes=10))
@@ -0,0 +1,559 @@
+"""Library helper"""
+import heapq
+import itertools
+import logging
+import math
+import multiprocessing
+import sys
+import threading
+import time
+from libsonic.errors import DataNotFoundError
+from spotisub import utils
+
+ALBUM_LIST_PAGE_SIZE = 500
+CANDIDATES_LIMIT = 50
+# words found in more songs than this only rescore candidates
+COMMON_TOKEN_FRACTION = 0.01
+COMMON_TOKEN_MIN_SONGS = 100
+
+
+class LibraryIndex:
+    """In-memory snapshot of the Subsonic library"""
+
+    def __init__(self):
+        self.artists = {}
+        self.artist_albums = {}
+        self.albums = {}
+        self.songs = {}
+        self.song_variants = {}
+        self.songs_by_artist = {}
+        self.songs_by_title = {}
+        self.songs_by_album = {}
+        self.songs_by_token = {}
+        self.generation = 0
+        self.tms_build = None
+        self.last_modified = None
+        self.last_scan = None
+        self.added_song_ids = set()
+
+    def copy(self):
+        """copy the index so it can be changed while readers use the old one"""
+        index = LibraryIndex()
+        index.artists = dict(self.artists)
+        index.artist_albums = {
+            key: set(value) for key, value in self.artist_albums.items()}
+        index.albums = dict(self.albums)
+        index.songs = dict(self.songs)
+        index.song_variants = dict(self.song_variants)
+        index.songs_by_artist = {
+            key: set(value) for key, value in self.songs_by_artist.items()}
+        index.songs_by_title = {
+            key: set(value) for key, value in self.songs_by_title.items()}
+        index.songs_by_album = {
+            key: set(value) for key, value in self.songs_by_album.items()}
+        index.songs_by_token = {
+            key: set(value) for key, value in self.songs_by_token.items()}
+        index.generation = self.generation
+        index.tms_build = self.tms_build
+        index.last_modified = self.last_modified
+        index.last_scan = self.last_scan
+        return index
+
+    def add_artist(self, artist):
+        """add artist to index"""
+        if "id" in artist:
+            self.artists[artist["id"]] = artist
+            if artist["id"] not in self.artist_albums:
+                self.artist_albums[artist["id"]] = set()
+
+    def remove_artist(self, artist_id):
+        """remove artist and all of its albums from index"""
+        for album_id in list(self.artist_albums.pop(artist_id, set())):
+            self.remove_album(album_id)
+        self.artists.pop(artist_id, None)
+
+    def add_album(self, album, artist_id=None):
+        """add album and its songs to index"""
+        if "id" not in album:
+            return
+        if album["id"] in self.albums:
+            self.remove_album(album["id"])
+        songs = album["song"] if "song" in album else []
+        self.albums[album["id"]] = {
+            key: value for key, value in album.items() if key != "song"}
+        self.albums[album["id"]]["song_ids"] = []
+        self.albums[album["id"]]["signature"] = get_album_signature(album)
+        if artist_id is None and "artistId" in album:
+            artist_id = album["artistId"]
+        self.albums[album["id"]]["index_artist_id"] = artist_id
+        if artist_id is not None:
+            if artist_id not in self.artist_albums:
+                self.artist_albums[artist_id] = set()
+            self.artist_albums[artist_id].add(album["id"])
+        for song in songs:
+            self.add_song(song)
+            if "id" in song:
+                self.albums[album["id"]]["song_ids"].append(song["id"])
+
+    def remove_album(self, album_id):
+        """remove album and its songs from index"""
+        album = self.albums.pop(album_id, None)
+        if album is not None:
+            for song_id in album["song_ids"]:
+                self.remove_song(song_id)
+            artist_id = album["index_artist_id"]
+            if artist_id is not None and artist_id in self.artist_albums:
+                self.artist_albums[artist_id].discard(album_id)
+
+    def add_song(self, song):
+        """add song to index"""
+        if ("id" not in song or "artist" not in song
+                or "title" not in song or "album" not in song):
+            return
+        self.songs[song["id"]] = song
+        self.added_song_ids.add(song["id"])
+        # library strings are normalized once, here
+        variants = SongVariants(
+            get_variants(song["artist"]),
+            get_variants(song["title"]),
+            get_variants(song["album"]),
+            utils.get_compare_tokens(song["artist"]) | utils.get_compare_tokens(song["title"]),
+            utils.is_excluded(song["title"]) or utils.is_excluded(song["album"]))
+        self.song_variants[song["id"]] = variants
+        add_to_key_index(self.songs_by_artist, variants.artist, song["id"])
+        add_to_key_index(self.songs_by_title, variants.title, song["id"])
+        add_to_key_index(self.songs_by_album, variants.album, song["id"])
+        add_to_key_index(self.songs_by_token, variants.tokens, song["id"])
+
+    def remove_song(self, song_id):
+        """remove song from index"""
+        song = self.songs.pop(song_id, None)
+        variants = self.song_variants.pop(song_id, None)
+        if song is not None and variants is not None:
+            remove_from_key_index(
+                self.songs_by_artist, variants.artist, song_id)
+            remove_from_key_index(
+                self.songs_by_title, variants.title, song_id)
+            remove_from_key_index(
+                self.songs_by_album, variants.album, song_id)
+            remove_from_key_index(
+                self.songs_by_token, variants.tokens, song_id)
+
+    def get_songs_by_artist(self, artist_name):
+        """get song ids by normalized artist name"""
+        song_ids = set()
+        for key in utils.get_compare_variants(artist_name):
+            if key in self.songs_by_artist:
+                song_ids.update(self.songs_by_artist[key])
+        return song_ids
+
+    def get_candidates(self, text, limit=CANDIDATES_LIMIT):
+        """get song ids sharing the most (and rarest) words with text"""
+        tokens = [token for token in utils.get_compare_tokens(text)
+                  if token in self.songs_by_token]
+        tokens.sort(key=lambda token: len(self.songs_by_token[token]))
+        total = max(len(self.songs), 1)
+        max_postings = max(COMMON_TOKEN_MIN_SONGS, total * COMMON_TOKEN_FRACTION)
+        if len(tokens) == 0:
+            return []
+        if len(self.songs_by_token[tokens[0]]) > max_postings:
+            # only common words, keep the songs sharing as many as possible
+            song_ids = self.songs_by_token[tokens[0]]
+            for token in tokens[1:]:
+                narrowed = song_ids & self.songs_by_token[token]
+                if len(narrowed) > 0:
+                    song_ids = narrowed
+            return list(itertools.islice(song_ids, limit))
+        scores = {}
+        for token in tokens:
+            postings = self.songs_by_token[token]
+            weight = math.log(1 + total / len(postings))
+            # every rare word adds its songs, so a rare word missing from the
+            # library title can't hide the songs sharing the other words,
+            # common words only rescore them
+            if len(postings) <= max_postings:
+                for song_id in postings:
+                    scores[song_id] = scores.get(song_id, 0) + weight
+            else:
+                for song_id in scores:
+                    if song_id in postings:
+                        scores[song_id] = scores[song_id] + weight
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+    def search(self, artist_names, title):
+        """get songs matching any of the artists and the title
+        without calling subsonic"""
+        result = {}
+        artists_variants = [utils.get_compare_variants(artist_name)
+                            for artist_name in artist_names]
+        title_variants = utils.get_compare_variants(title)
+        for song_id in self.get_candidates(" ".join(artist_names) + " " + title):
+            variants = self.song_variants[song_id]
+            if (utils.compare(title_variants, variants.title)
+                    and any(utils.compare(artist_variants, variants.artist)
+                            for artist_variants in artists_variants)):
+                result[song_id] = dict(self.songs[song_id])
+        return result
+
+
+class SongVariants:
+    """Normalized compare variants of a library song"""
+
+    def __init__(self, artist, title, album, tokens, excluded):
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.tokens = tokens
+        self.excluded = excluded
+
+
+def get_variants(value):
+    """get normalized compare variants of a library string"""
+    if value is None or value.strip() == "":
+        return ()
+    return utils.get_compare_variants(value)
+
+
+def add_to_key_index(key_index, variants, song_id):
+    """add song id under every normalized variant"""
+    for key in variants:
+        if key != "":
+            if key not in key_index:
+                key_index[key] = set()
+            key_index[key].add(song_id)
+
+
+def remove_from_key_index(key_index, variants, song_id):
+    """remove song id from every normalized variant"""
+    for key in variants:
+        if key in key_index:
+            key_index[key].discard(song_id)
+            if len(key_index[key]) == 0:
+                del key_index[key]
+
+
+def get_album_marker(album):
+    """get album changed or created timestamp"""
+    if "changed" in album and album["changed"] is not None:
+        return str(album["changed"])
+    if "created" in album and album["created"] is not None:
+        return str(album["created"])
+    return None
+
+
+def get_album_signature(album):
+    """get a value that changes whenever the album changes"""
+    song_count = album["songCount"] if "songCount" in album else None
+    return str(get_album_marker(album)) + "|" + str(song_count)
+
+
+def get_artist_signature(artist):
+    """get a value that changes whenever the artist changes"""
+    album_count = artist["albumCount"] if "albumCount" in artist else None
+    return str(artist["name"] if "name" in artist else None) + \
+        "|" + str(album_count)
+
+
+library_index = None
+refresh_lock = threading.Lock()
+process_backend_refused = False
+
+
+def is_ready():
+    """check if the library index has been built"""
+    return library_index is not None
+
+
+def get_library_index():
+    """get current library index"""
+    return library_index
+
+
+def is_song_excluded(song):
+    """check excluded words in song title and album, cached in the index"""
+    index = library_index
+    if index is not None and song["id"] in index.song_variants:
+        return index.song_variants[song["id"]].excluded
+    return utils.is_excluded(song["title"]) or utils.is_excluded(song["album"])
+
+
+def search(artist_names, title):
+    """search library index"""
+    index = library_index
+    if index is None:
+        return None
+    return index.search(artist_names, title)
+
+
+def can_search_in_processes():
+    """check if worker processes can inherit the library index, forking
+    is refused under eventlet as the gunicorn eventlet worker does"""
+    global process_backend_refused
+    if library_index is None or "fork" not in multiprocessing.get_all_start_methods():
+        return False
+    if is_eventlet_patched():
+        if not process_backend_refused:
+            # forking copies the patched hub and pool.map blocks every green thread
+            logging.warning(
+                '(%s) The process matching backend is not supported under eventlet, '
+                'searching in threads instead',
+                str(threading.current_thread().ident))
+            process_backend_refused = True
+        return False
+    return True
+
+
+def is_eventlet_patched():
+    """check if eventlet monkey patched the threading or os modules"""
+    patcher = sys.modules.get("eventlet.patcher")
+    return patcher is not None and (
+        patcher.is_monkey_patched("thread") or patcher.is_monkey_patched("os"))
+
+
+def search_in_processes(queries, workers):
+    """search (artist names, title) pairs sharding them over forked processes,
+    which inherit the library index instead of receiving a copy of it"""
+    index = library_index
+    if index is None:
+        return [None for query in queries]
+    if len(queries) == 0:
+        return []
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=workers) as pool:
+        results = pool.map(
+            search_song_ids,
+            queries,
+            chunksize=max(1, len(queries) // (workers * 4)))
+    return [{song_id: dict(index.songs[song_id])
+             for song_id in song_ids if song_id in index.songs}
+            for song_ids in results]
+
+
+def search_song_ids(query):
+    """search the inherited library index, only song ids go back to the parent"""
+    return list(library_index.search(query[0], query[1]).keys())
+
+
+def get_artists_array_names():
+    """get artists names from library index"""
+    index = library_index
+    if index is None:
+        return None
+    artist_names = []
+    for artist in index.artists.values():
+        if "name" in artist:
+            artist_names.append(artist["name"])
+    return artist_names
+
+
+def get_artist_index(pysonic, artist_name):
+    """get an index of a single artist discography, None if not found"""
+    artist_index = None
+    index = library_index
+    artists = list(index.artists.values()) if index is not None else get_artists(pysonic)
+    for artist in artists:
+        if ("id" in artist and "name" in artist
+                and artist["name"].strip().lower() == artist_name.strip().lower()):
+            if artist_index is None:
+                artist_index = LibraryIndex()
+            if index is not None:
+                artist_index.add_artist(artist)
+                for album_id in index.artist_albums.get(artist["id"], set()):
+                    album = dict(index.albums[album_id])
+                    album["song"] = [index.songs[song_id] for song_id in album["song_ids"]
+                                     if song_id in index.songs]
+                    artist_index.add_album(album, artist_id=artist["id"])
+            else:
+                sync_artist(pysonic, artist_index, artist)
+    return artist_index
+
+
+def get_artists(pysonic):
+    """get flat list of subsonic artists"""
+    artists = []
+    artists_search = pysonic.getArtists()
+    if "artists" in artists_search and "index" in artists_search["artists"]:
+        for artist_index in artists_search["artists"]["index"]:
+            if "artist" in artist_index:
+                artists.extend(artist_index["artist"])
+    return artists
+
+
+def get_artists_names_from_subsonic(pysonic):
+    """get artists names with a single getArtists call"""
+    artist_names = []
+    for artist in get_artists(pysonic):
+        if "name" in artist:
+            artist_names.append(artist["name"])
+    return artist_names
+
+
+def is_scanning(pysonic):
+    """check if subsonic is scanning the music folders"""
+    try:
+        scan_status = pysonic.getScanStatus()
+    except DataNotFoundError:
+        return False, None
+    if "scanStatus" in scan_status:
+        last_scan = scan_status["scanStatus"]["lastScan"] if "lastScan" in scan_status["scanStatus"] else None
+        return scan_status["scanStatus"]["scanning"] is True, last_scan
+    return False, None
+
+
+def get_last_modified(pysonic, if_modified_since=0):
+    """get indexes last modified marker"""
+    indexes = pysonic.getIndexes(ifModifiedSince=if_modified_since)
+    if "indexes" in indexes and "lastModified" in indexes["indexes"]:
+        return indexes["indexes"]["lastModified"]
+    return None
+
+
+def get_library_version(pysonic):
+    """get a stamp that changes whenever the subsonic library changes"""
+    index = library_index
+    if index is not None and index.last_modified is not None:
+        return str(index.last_modified)
+    # asking for changes since now only returns the last modified marker
+    last_modified = get_last_modified(
+        pysonic, if_modified_since=int(time.time() * 1000))
+    return str(last_modified) if last_modified is not None else None
+
+
+def sync_album(pysonic, index, album, artist_id):
+    """fetch album songs if the album is new or changed"""
+    if (album["id"] in index.albums
+            and index.albums[album["id"]]["signature"] == get_album_signature(album)):
+        return False
+    try:
+        album_search = pysonic.getAlbum(album["id"])
+    except DataNotFoundError:
+        index.remove_album(album["id"])
+        return True
+    index.add_album(album_search["album"], artist_id=artist_id)
+    return True
+
+
+def sync_artist(pysonic, index, artist):
+    """fetch artist albums, then only new or changed albums"""
+    try:
+        artist_search = pysonic.getArtist(artist["id"])
+    except DataNotFoundError:
+        index.remove_artist(artist["id"])
+        return 0
+    index.add_artist(artist)
+    albums = artist_search["artist"]["album"] if "album" in artist_search["artist"] else []
+    album_ids = set()
+    changed = 0
+    for album in albums:
+        album_ids.add(album["id"])
+        if sync_album(pysonic, index, album, artist["id"]):
+            changed = changed + 1
+    for album_id in list(index.artist_albums[artist["id"]] - album_ids):
+        index.remove_album(album_id)
+        changed = changed + 1
+    return changed
+
+
+def sync_all_albums(pysonic, index):
+    """walk the whole album list, fetching albums whose signature changed
+    and removing the ones not listed anymore"""
+    changed = 0
+    offset = 0
+    album_ids = set()
+    while True:
+        album_list = pysonic.getAlbumList2(
+            "alphabeticalByName", size=ALBUM_LIST_PAGE_SIZE, offset=offset)
+        albums = []
+        if "albumList2" in album_list and "album" in album_list["albumList2"]:
+            albums = album_list["albumList2"]["album"]
+        for album in albums:
+            album_ids.add(album["id"])
+            artist_id = album["artistId"] if "artistId" in album else None
+            if album["id"] in index.albums:
+                artist_id = index.albums[album["id"]]["index_artist_id"]
+            if sync_album(pysonic, index, album, artist_id):
+                changed = changed + 1
+        if len(albums) < ALBUM_LIST_PAGE_SIZE:
+            break
+        offset = offset + ALBUM_LIST_PAGE_SIZE
+    for album_id in list(index.albums.keys()):
+        if album_id not in album_ids:
+            index.remove_album(album_id)
+            changed = changed + 1
+    return changed
+
+
+def build(pysonic):
+    """sweep the whole library: artists, albums and songs"""
+    index = LibraryIndex()
+    for artist in get_artists(pysonic):
+        sync_artist(pysonic, index, artist)
+    return index
+
+
+def update(pysonic, index):
+    """refetch only new or changed artists and albums"""
+    index = index.copy()
+    changed = 0
+    artist_ids = set()
+    for artist in get_artists(pysonic):
+        artist_ids.add(artist["id"])
+        if (artist["id"] not in index.artists
+                or get_artist_signature(index.artists[artist["id"]]) != get_artist_signature(artist)):
+            changed = changed + 1 + sync_artist(pysonic, index, artist)
+    for artist_id in list(index.artists.keys()):
+        if artist_id not in artist_ids:
+            index.remove_artist(artist_id)
+            changed = changed + 1
+    changed = changed + sync_all_albums(pysonic, index)
+    return index, changed
+
+
+def refresh(pysonic):
+    """refresh the library index, rebuilding it only the first time"""
+    global library_index
+    if not refresh_lock.acquire(blocking=False):
+        logging.info(
+            '(%s) Library index refresh already running, skipping',
+            str(threading.current_thread().ident))
+        return library_index
+    try:
+        start = time.time()
+        scanning, last_scan = is_scanning(pysonic)
+        if scanning:
+            logging.info(
+                '(%s) Subsonic is scanning your library, postponing library index refresh',
+                str(threading.current_thread().ident))
+            return library_index
+        old_index = library_index
+        if old_index is not None:
+            last_modified = get_last_modified(
+                pysonic, if_modified_since=old_index.last_modified or 0)
+            if (last_modified is not None
+                    and last_modified == old_index.last_modified
+                    and last_scan == old_index.last_scan):
+                logging.info(
+                    '(%s) Library not modified since last refresh',
+                    str(threading.current_thread().ident))
+                return library_index
+            index, changed = update(pysonic, old_index)
+            index.generation = old_index.generation + \
+                (1 if changed > 0 else 0)
+        else:
+            last_modified = get_last_modified(pysonic)
+            index = build(pysonic)
+            index.generation = 1
+        index.last_modified = last_modified
+        index.last_scan = last_scan
+        index.tms_build = time.time()
+        library_index = index
+        logging.info(
+            '(%s) Library index refreshed: %s artists, %s albums, %s songs in %.1fs',
+            str(threading.current_thread().ident),
+            len(index.artists),
+            len(index.albums),
+            len(index.songs),
+            index.tms_build - start)
+        return library_index
+    finally:
+        refresh_lock.release()
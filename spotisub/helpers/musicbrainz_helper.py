@@ -1,10 +1,14 @@
 """Musicbrainz helper"""
+import os
 import time
 import logging
+import threading
 
 
 import musicbrainzngs
 from spotisub import spotisub
+from spotisub import constants
+from spotisub import database
 from spotisub import utils
 
 
@@ -18,6 +22,20 @@ musicbrainzngs.set_useragent(
     "0.1",
     "http://example.com/music")
 
+# MusicBrainz allows one request per second
+rate_limit_lock = threading.Lock()
+last_request = 0
+
+
+def wait_rate_limit():
+    """wait until a new musicbrainz request is allowed"""
+    global last_request
+    with rate_limit_lock:
+        wait = last_request + 1 - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        last_request = time.time()
+
 
 def get_isrc_by_id(song):
     """get isrc by id"""
@@ -25,16 +43,53 @@ def get_isrc_by_id(song):
         if ("musicBrainzId" in song
             and song["musicBrainzId"] is not None
                 and song["musicBrainzId"] != ""):
-            song = musicbrainzngs.get_recording_by_id(
-                song["musicBrainzId"], includes=["isrcs"])
-            time.sleep(1)
-            if (song is not None and "recording" in song
-                and song["recording"] is not None
-                and "isrc-list" in song["recording"]
-                and song["recording"]["isrc-list"] is not None
-                    and len(song["recording"]["isrc-list"])) > 0:
-                return song["recording"]["isrc-list"]
+            isrc_list = get_cached_isrc_by_id(song["musicBrainzId"])
+            if isrc_list is None:
+                isrc_list = load_isrc_by_id(song["musicBrainzId"])
+            return isrc_list
         return []
     except BaseException:
         utils.write_exception()
         return []
+
+
+def is_cached(musicbrainz_id):
+    """check if a recording is in the cache and not expired"""
+    return get_cached_isrc_by_id(musicbrainz_id) is not None
+
+
+def get_cached_isrc_by_id(musicbrainz_id):
+    """get cached isrc list, None if not cached or expired"""
+    recording = database.select_musicbrainz_recording(
+        musicbrainz_id,
+        int(os.environ.get(constants.MUSICBRAINZ_CACHE_TTL,
+                           constants.MUSICBRAINZ_CACHE_TTL_DEFAULT_VALUE)),
+        int(os.environ.get(constants.MUSICBRAINZ_NEGATIVE_CACHE_TTL,
+                           constants.MUSICBRAINZ_NEGATIVE_CACHE_TTL_DEFAULT_VALUE)))
+    if recording is None:
+        return None
+    if recording.isrc_list == "":
+        return []
+    return recording.isrc_list.split(",")
+
+
+def load_isrc_by_id(musicbrainz_id):
+    """get isrc list from musicbrainz and store it in the cache"""
+    wait_rate_limit()
+    try:
+        song = musicbrainzngs.get_recording_by_id(
+            musicbrainz_id, includes=["isrcs"])
+    except musicbrainzngs.ResponseError as ex:
+        if ex.cause is not None and getattr(ex.cause, "code", None) == 404:
+            database.insert_or_update_musicbrainz_recording(
+                musicbrainz_id, [])
+            return []
+        raise ex
+    isrc_list = []
+    if (song is not None and "recording" in song
+        and song["recording"] is not None
+        and "isrc-list" in song["recording"]
+            and song["recording"]["isrc-list"] is not None):
+        isrc_list = song["recording"]["isrc-list"]
+    database.insert_or_update_musicbrainz_recording(musicbrainz_id, isrc_list)
+    return isrc_list
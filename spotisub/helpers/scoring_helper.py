@@ -0,0 +1,125 @@
+"""Scoring helper"""
+import logging
+import threading
+import time
+import numpy
+from scipy import sparse
+from spotisub import utils
+
+NGRAM_SIZE = 3
+# n-grams found in more than this fraction of the library carry no signal
+MAX_NGRAM_DOCUMENT_FREQUENCY = 0.05
+QUERY_CHUNK_SIZE = 256
+CANDIDATES_PER_TRACK = 5
+
+
+class LibraryVectors:
+    """Char n-gram TF-IDF vectors of the library index songs"""
+
+    def __init__(self, generation, song_ids, vocabulary, idf, matrix):
+        self.generation = generation
+        self.song_ids = song_ids
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+        # transposed once, reused by every playlist
+        self.matrix_t = matrix.T.tocsr()
+
+
+def get_ngrams(value):
+    """get char n-grams of a normalized string"""
+    value = " " + " ".join(sorted(utils.get_compare_tokens(value))) + " "
+    return [value[i:i + NGRAM_SIZE]
+            for i in range(len(value) - NGRAM_SIZE + 1)]
+
+
+def get_song_text(song):
+    """get the text used to vectorize a library song"""
+    return song["artist"] + " " + song["title"]
+
+
+def build_vectors(index):
+    """vectorize every song of the library index"""
+    song_ids = list(index.songs.keys())
+    documents = [get_ngrams(get_song_text(index.songs[song_id]))
+                 for song_id in song_ids]
+    document_frequency = {}
+    for ngrams in documents:
+        for ngram in set(ngrams):
+            document_frequency[ngram] = document_frequency.get(ngram, 0) + 1
+    max_frequency = max(1, int(len(documents) * MAX_NGRAM_DOCUMENT_FREQUENCY))
+    vocabulary = {}
+    for ngram, frequency in document_frequency.items():
+        if frequency <= max_frequency or len(documents) < 100:
+            vocabulary[ngram] = len(vocabulary)
+    idf = numpy.zeros(len(vocabulary), dtype=numpy.float32)
+    for ngram, column in vocabulary.items():
+        idf[column] = numpy.log(
+            (1 + len(documents)) / (1 + document_frequency[ngram])) + 1
+    matrix = vectorize(documents, vocabulary, idf)
+    return LibraryVectors(index.generation, song_ids, vocabulary, idf, matrix)
+
+
+def vectorize(documents, vocabulary, idf):
+    """build a L2 normalized sparse tf-idf matrix, one row per document"""
+    rows = []
+    columns = []
+    for row, ngrams in enumerate(documents):
+        for ngram in ngrams:
+            if ngram in vocabulary:
+                rows.append(row)
+                columns.append(vocabulary[ngram])
+    data = numpy.ones(len(rows), dtype=numpy.float32)
+    matrix = sparse.csr_matrix(
+        (data, (rows, columns)),
+        shape=(len(documents), len(vocabulary)),
+        dtype=numpy.float32)
+    matrix.sum_duplicates()
+    matrix = matrix @ sparse.diags(idf)
+    norms = numpy.sqrt(matrix.multiply(matrix).sum(axis=1)).A1
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+library_vectors = None
+vectors_lock = threading.Lock()
+
+
+def get_library_vectors(index):
+    """get library vectors, rebuilding them when the index changed"""
+    global library_vectors
+    with vectors_lock:
+        if library_vectors is None or library_vectors.generation != index.generation:
+            start = time.time()
+            library_vectors = build_vectors(index)
+            logging.info(
+                '(%s) Library vectors built: %s songs, %s n-grams in %.1fs',
+                str(threading.current_thread().ident),
+                len(library_vectors.song_ids),
+                len(library_vectors.vocabulary),
+                time.time() - start)
+        return library_vectors
+
+
+def score_playlist(index, texts, min_score):
+    """score every text against the whole library in sparse matrix products,
+    return for each text the best library song ids with their scores"""
+    vectors = get_library_vectors(index)
+    results = []
+    if len(vectors.song_ids) == 0:
+        return [[] for text in texts]
+    for chunk in range(0, len(texts), QUERY_CHUNK_SIZE):
+        query_matrix = vectorize(
+            [get_ngrams(text) for text in texts[chunk:chunk + QUERY_CHUNK_SIZE]],
+            vectors.vocabulary,
+            vectors.idf)
+        scores = (query_matrix @ vectors.matrix_t).tocsr()
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            row_scores = scores.data[start:end]
+            row_columns = scores.indices[start:end]
+            best = numpy.argsort(-row_scores)[:CANDIDATES_PER_TRACK]
+            results.append([(vectors.song_ids[row_columns[position]], float(row_scores[position]))
+                            for position in best
+                            if row_scores[position] >= min_score])
+    return results
@@ -1,13 +1,79 @@
 """Spotipy helper"""
 import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import spotipy
 from spotipy import SpotifyOAuth
+from spotipy.exceptions import SpotifyException
 from spotisub import spotisub
 from spotisub import constants
+from spotisub.classes import TokenBucket
 from spotisub.exceptions import SpotifyApiException
 
 
 SP = None
+MAX_THROTTLED_RETRIES = 5
+# 429 is left out so that Retry-After reaches the rate limiter
+STATUS_RETRY_CODES = (500, 502, 503, 504)
+PAGE_WORKERS = 4
+
+rate_limiter = TokenBucket(
+    float(os.environ.get(
+        constants.SPOTIFY_RATE_LIMIT,
+        constants.SPOTIFY_RATE_LIMIT_DEFAULT_VALUE)),
+    int(os.environ.get(
+        constants.SPOTIFY_RATE_BURST,
+        constants.SPOTIFY_RATE_BURST_DEFAULT_VALUE)))
+
+
+class RateLimitedSpotify(spotipy.Spotify):
+    """Spotipy client sharing one rate limiter between all the calls"""
+
+    def _internal_call(self, method, url, payload, params):
+        retries = 0
+        while True:
+            rate_limiter.acquire()
+            try:
+                result = super()._internal_call(method, url, payload, params)
+                rate_limiter.succeed()
+                return result
+            except SpotifyException as e:
+                if e.http_status != 429 or retries >= MAX_THROTTLED_RETRIES:
+                    raise
+                retry_after = get_retry_after(e)
+                rate_limiter.backoff(retry_after)
+                retries += 1
+                logging.warning(
+                    '(%s) Spotify rate limit reached, retrying in %ss',
+                    str(threading.current_thread().ident),
+                    retry_after)
+
+
+def get_retry_after(exception):
+    """get the seconds to wait from a 429 response"""
+    try:
+        return max(1, int(exception.headers["Retry-After"]))
+    except (TypeError, KeyError, ValueError):
+        return 1
+
+
+def get_rate_limit_metrics():
+    """get Spotify api rate usage and throttling time"""
+    return rate_limiter.get_metrics()
+
+
+def get_all_items(get_page, limit):
+    """yield the items of a paged Spotify endpoint in order,
+    fetching the pages after the first one concurrently"""
+    first_page = get_page(0, limit)
+    yield from first_page['items']
+    offsets = range(limit, first_page['total'], limit)
+    if len(offsets) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        for page in executor.map(lambda offset: get_page(offset, limit), offsets):
+            yield from page['items']
 
 
 def get_secrets():
@@ -46,7 +112,9 @@ def create_sp_client():
         open_browser=False,
         cache_path=cache_path)
 
-    return spotipy.Spotify(auth_manager=creds)
+    return RateLimitedSpotify(
+        auth_manager=creds,
+        status_forcelist=STATUS_RETRY_CODES)
 
 
 def get_spotipy_client():
@@ -3,8 +3,9 @@ import logging
 import os
 import random
 import time
-import pickle
+import json
 import threading
+import contextlib
 import libsonic
 import string
 from concurrent.futures import ThreadPoolExecutor
@@ -19,7 +20,9 @@ from spotisub.exceptions import SubsonicOfflineException
 from spotisub.exceptions import SpotifyApiException
 from spotisub.exceptions import SpotifyDataException
 from spotisub.classes import ComparisonHelper
+from spotisub.classes import SearchMemo
 from spotisub.helpers import musicbrainz_helper
+from spotisub.helpers import library_helper
 
 cache_executor = ThreadPoolExecutor(max_workers=2)
 
@@ -32,6 +35,14 @@ if os.environ.get(constants.SPOTDL_ENABLED,
         "path and check that you have enough disk space " +
         "for music downloading.")
 
+if os.environ.get(constants.BATCH_MATCHING_ENABLED,
+                  constants.BATCH_MATCHING_ENABLED_DEFAULT_VALUE) == "1":
+    from spotisub.helpers import scoring_helper
+    logging.warning(
+        "You have enabled BATCH MATCHING, " +
+        "the whole library will be vectorized in memory " +
+        "each time the library index changes.")
+
 if os.environ.get(constants.LIDARR_ENABLED,
                   constants.LIDARR_ENABLED_DEFAULT_VALUE) == "1":
     from spotisub.helpers import lidarr_helper
@@ -57,43 +68,37 @@ pysonic = libsonic.Connection(
             constants.SUBSONIC_API_PORT)))
 
 
+PLAYLIST_UPDATE_CHUNK_SIZE = 100
+SEARCH_SONG_COUNT = 500
+# a reimport runs thousands of searches, keep only the recent ones
+SEARCH_MEMO_MAX_RESPONSES = 2000
+
 # caches
 playlist_cache = ExpiringDict(max_len=500, max_age_seconds=300)
-spotify_cache = None
+SPOTIFY_CACHE_TTL_SECONDS = 43200
+# max ids accepted by the spotify several items endpoints
+SPOTIFY_BATCH_SIZES = {"track": 50, "album": 20, "artist": 50}
+search_memo = threading.local()
 
 
-def load_spotify_cache_from_file():
-    object = ExpiringDict(max_len=10000, max_age_seconds=43200)
+def remove_spotify_cache_file():
+    """remove the pickled cache used by older versions"""
     path = os.path.abspath(os.curdir) + '/cache/spotify_object_cache.pkl'
     if os.path.exists(path):
-        if os.stat(path).st_size == 0:
-            os.remove(path)
-        else:
-            with open(path, 'rb') as f:
-                old_cache_obj = pickle.load(f)
-                for key, value in old_cache_obj.items():
-                    object[key] = value
-    return object
-
-
-def save_spotify_cache_to_file(object):
-    path = os.path.abspath(os.curdir) + '/cache/spotify_object_cache.pkl'
-    with open(path, 'wb') as f:
-        pickle.dump(object, f)
+        os.remove(path)
 
 
 def get_spotify_object_from_cache(sp, spotify_uri):
-    if spotify_uri in spotify_cache:
-        return spotify_cache[spotify_uri]
-    else:
-        cache_executor.submit(load_spotify_object_to_cache, sp, spotify_uri)
+    spotify_object = database.select_spotify_object(spotify_uri)
+    if spotify_object is not None:
+        return json.loads(spotify_object)
+    cache_executor.submit(load_spotify_object_to_cache, sp, spotify_uri)
     return None
 
 
 def load_spotify_object_to_cache(sp, spotify_uri):
     try:
-        global spotify_cache
-        if spotify_uri in spotify_cache:
+        if database.select_spotify_object(spotify_uri) is not None:
             return
         spotify_object = None
         if "track" in spotify_uri:
@@ -105,12 +110,50 @@ def load_spotify_object_to_cache(sp, spotify_uri):
         elif "playlist" in spotify_uri:
             spotify_object = sp.playlist(spotify_uri)
         if spotify_object is not None:
-            spotify_cache[spotify_uri] = spotify_object
-            save_spotify_cache_to_file(spotify_cache)
+            database.insert_or_update_spotify_object(
+                spotify_uri, json.dumps(spotify_object), SPOTIFY_CACHE_TTL_SECONDS)
     except SpotifyException:
         utils.write_exception()
         pass
 
+def load_spotify_objects_to_cache(sp, spotify_uris):
+    """fetch the spotify objects missing from cache with the several
+    items endpoints, synchronously"""
+    cached = database.select_spotify_objects(spotify_uris)
+    missing_ids = {}
+    for spotify_uri in dict.fromkeys(spotify_uris):
+        if spotify_uri not in cached:
+            uri_parts = spotify_uri.split(":")
+            if len(uri_parts) == 3 and uri_parts[1] in SPOTIFY_BATCH_SIZES:
+                missing_ids.setdefault(uri_parts[1], []).append(uri_parts[2])
+            else:
+                load_spotify_object_to_cache(sp, spotify_uri)
+    for object_type, ids in missing_ids.items():
+        batch_size = SPOTIFY_BATCH_SIZES[object_type]
+        for chunk in range(0, len(ids), batch_size):
+            batch_ids = ids[chunk:chunk + batch_size]
+            try:
+                spotify_objects = get_several_spotify_objects(
+                    sp, object_type, batch_ids)
+            except SpotifyException:
+                utils.write_exception()
+                continue
+            database.insert_or_update_spotify_objects(
+                {'spotify:' + object_type + ':' + spotify_id: json.dumps(spotify_object)
+                 for spotify_id, spotify_object in zip(batch_ids, spotify_objects)
+                 if spotify_object is not None},
+                SPOTIFY_CACHE_TTL_SECONDS)
+
+
+def get_several_spotify_objects(sp, object_type, ids):
+    """get spotify objects of one type, in the order of ids"""
+    if object_type == "track":
+        return sp.tracks(ids)["tracks"]
+    if object_type == "album":
+        return sp.albums(ids)["albums"]
+    return sp.artists(ids)["artists"]
+
+
 def check_pysonic_connection():
     """Return SubsonicOfflineException if pysonic is offline"""
     if pysonic.ping():
@@ -120,46 +163,178 @@ def check_pysonic_connection():
 
 def get_artists_array_names():
     """get artists array names"""
-    check_pysonic_connection().getArtists()
-
-    artist_names = []
-
-    for index in check_pysonic_connection().getArtists()["artists"]["index"]:
-        for artist in index["artist"]:
-            if "name" in artist:
-                artist_names.append(artist["name"])
-
+    artist_names = None
+    if is_library_index_enabled():
+        artist_names = library_helper.get_artists_array_names()
+    if artist_names is None:
+        artist_names = library_helper.get_artists_names_from_subsonic(
+            check_pysonic_connection())
     return artist_names
 
 
 def search_artist(artist_name):
     """search artist"""
 
-    for index in check_pysonic_connection().getArtists()["artists"]["index"]:
-        for artist in index["artist"]:
-            if "name" in artist:
-                if artist_name.strip().lower(
-                ) == artist["name"].strip().lower():
-                    return artist["name"]
+    for name in get_artists_array_names():
+        if artist_name.strip().lower() == name.strip().lower():
+            return name
 
     return None
 
 
+def get_search_memo():
+    """get the search memo of the current run, if any"""
+    return getattr(search_memo, "current", None)
+
+
+@contextlib.contextmanager
+def search_memo_scope(memo=None):
+    """memoize subsonic search responses for the duration of a run,
+    nested scopes share the memo of the outermost one and worker
+    threads join the run passing its memo"""
+    current = get_search_memo()
+    if current is not None:
+        yield current
+        return
+    search_memo.current = memo if memo is not None else SearchMemo(
+        SEARCH_MEMO_MAX_RESPONSES)
+    try:
+        yield search_memo.current
+    finally:
+        search_memo.current = None
+
+
+def search_songs(query):
+    """search2 songs, using the run memo when one is active"""
+    query = " ".join(query.split())
+    memo = get_search_memo()
+    if memo is not None:
+        songs = memo.get(query)
+        if songs is not None:
+            return songs
+    subsonic_search = check_pysonic_connection().search2(
+        query, songCount=SEARCH_SONG_COUNT)
+    songs = []
+    if ("searchResult2" in subsonic_search
+        and len(subsonic_search["searchResult2"]) > 0
+            and "song" in subsonic_search["searchResult2"]):
+        songs = subsonic_search["searchResult2"]["song"]
+    if memo is not None:
+        memo.put(query, songs)
+    return songs
+
+
 def get_subsonic_search_results(text_to_search):
     """get subsonic search results"""
+    return search_with_plan(text_to_search)[0]
+
+
+def search_with_plan(text_to_search):
+    """get subsonic search results, and whether a query
+    returned as many songs as the search limit"""
     result = {}
-    set_searches = utils.generate_compare_array(text_to_search)
+    truncated = False
+    complete_searches = []
+    saved = 0
+    set_searches = utils.get_search_plan(text_to_search)
     for set_search in set_searches:
-        subsonic_search = check_pysonic_connection().search2(set_search, songCount=500)
-        if ("searchResult2" in subsonic_search
-            and len(subsonic_search["searchResult2"]) > 0
-                and "song" in subsonic_search["searchResult2"]):
-            for song in subsonic_search["searchResult2"]["song"]:
-                if "id" in song and song["id"] not in result:
-                    result[song["id"]] = song
+        # a complete result of a broader query already
+        # contains every song this query could return
+        if utils.is_covered_by(set_search, complete_searches):
+            saved = saved + 1
+            continue
+        songs = search_songs(set_search)
+        for song in songs:
+            if "id" in song and song["id"] not in result:
+                result[song["id"]] = song
+        if len(songs) < SEARCH_SONG_COUNT:
+            complete_searches.append(set_search)
+        else:
+            truncated = True
+    if saved > 0:
+        logging.debug(
+            '(%s) Search plan for %s saved %s of %s Subsonic round trips',
+            str(threading.current_thread().ident),
+            text_to_search,
+            saved,
+            len(set_searches))
+    return result, truncated
+
+
+def refresh_library_index():
+    """refresh the in-memory library index"""
+    try:
+        index = library_helper.refresh(check_pysonic_connection())
+        if index is not None and len(index.added_song_ids) > 0:
+            isrc_songs = []
+            for song_id in index.added_song_ids:
+                if song_id in index.songs:
+                    song = index.songs[song_id]
+                    musicbrainz_id = song["musicBrainzId"] if "musicBrainzId" in song else None
+                    for isrc in get_song_isrcs(song):
+                        isrc_songs.append({"isrc": isrc,
+                                           "subsonic_song_id": song_id,
+                                           "musicbrainz_id": musicbrainz_id})
+            database.insert_isrcs(isrc_songs)
+            index.added_song_ids = set()
+    except SubsonicOfflineException:
+        logging.error(
+            '(%s) There was an error indexing your library, perhaps is your Subsonic server offline?',
+            str(threading.current_thread().ident))
+
+
+def warmup_musicbrainz_cache():
+    """resolve isrcs of library songs missing from the musicbrainz cache"""
+    index = library_helper.get_library_index()
+    if index is None:
+        return
+    count = 0
+    for song in list(index.songs.values()):
+        # songs tagged with an isrc are already in the isrc index
+        if ("musicBrainzId" in song
+            and song["musicBrainzId"] is not None
+            and song["musicBrainzId"] != ""
+            and len(get_song_isrcs(song)) == 0
+                and not musicbrainz_helper.is_cached(song["musicBrainzId"])):
+            add_to_isrc_index(song, musicbrainz_helper.get_isrc_by_id(song))
+            count = count + 1
+    logging.info(
+        '(%s) MusicBrainz cache warmup completed, %s recordings loaded',
+        str(threading.current_thread().ident), count)
+
+
+def is_library_index_enabled():
+    """check if the library index is enabled"""
+    return os.environ.get(
+        constants.LIBRARY_INDEX_SCHED,
+        constants.LIBRARY_INDEX_SCHED_DEFAULT_VALUE) != "0"
+
+
+def get_library_search_results(artist_names, title):
+    """get candidates for any of the artists from the library index,
+    falling back to subsonic search"""
+    if is_library_index_enabled() and library_helper.is_ready():
+        return library_helper.search(artist_names, title)
+    if len(artist_names) == 1:
+        return get_subsonic_search_results(artist_names[0] + " " + title)
+    # a single search for all the credited artists, the prefilter checks each of them
+    result, truncated = search_with_plan(title)
+    if truncated:
+        # a common title fills the search limit, the right song may be left out
+        for artist_name in artist_names:
+            for song_id, song in get_subsonic_search_results(
+                    artist_name + " " + title).items():
+                if song_id not in result:
+                    result[song_id] = song
     return result
 
 
+def get_track_artist_names(track):
+    """get the names of the artists credited on a spotify track"""
+    return [artist_spotify["name"] for artist_spotify in track['artists']
+            if artist_spotify != '' and "name" in artist_spotify]
+
+
 def get_playlist_id_by_name(playlist_name):
     """get playlist id by name"""
     playlist_id = None
@@ -187,6 +362,29 @@ def has_isrc(track):
     return True
 
 
+def enrich_tracks(sp, tracks):
+    """complete the tracks missing album or isrc in batches, before matching"""
+    uris = ['spotify:track:' + track['id'] for track in tracks
+            if track is not None and "id" in track and track["id"] is not None
+            and ("album" not in track or has_isrc(track) is False)]
+    if len(uris) == 0:
+        return tracks
+    load_spotify_objects_to_cache(sp, uris)
+    cached = database.select_spotify_objects(uris)
+    enriched_tracks = []
+    for track in tracks:
+        if (track is not None and "id" in track and track["id"] is not None
+                and 'spotify:track:' + track['id'] in cached):
+            track = json.loads(cached['spotify:track:' + track['id']])
+        enriched_tracks.append(track)
+    logging.info(
+        '(%s) Completed %s of %s tracks with Spotify metadata',
+        str(threading.current_thread().ident),
+        len(cached),
+        len(uris))
+    return enriched_tracks
+
+
 def add_missing_values_to_track(sp, track):
     """calls spotify if tracks has missing album or isrc or uri"""
     if "id" in track:
@@ -195,7 +393,6 @@ def add_missing_values_to_track(sp, track):
             spotify_track = get_spotify_object_from_cache(sp, uri)
             if spotify_track is not None:
                 track = spotify_track
-            time.sleep(1)
         if "uri" not in track:
             track["uri"] = uri
         return track
@@ -211,6 +408,20 @@ def generate_playlist(playlist_info):
 
 def write_playlist(sp, playlist_info, results):
     """write playlist to subsonic db"""
+    with search_memo_scope() as memo:
+        hits = memo.hits
+        match_stats = {}
+        write_playlist_tracks(sp, playlist_info, results, match_stats)
+        logging.info(
+            '(%s) Playlist %s run summary: %s search cache hits, match stages: %s',
+            str(threading.current_thread().ident),
+            playlist_info["name"],
+            memo.hits - hits,
+            format_match_stats(match_stats))
+
+
+def write_playlist_tracks(sp, playlist_info, results, match_stats=None):
+    """match playlist tracks and write them to subsonic"""
     try:
         playlist_info["prefix"] = os.environ.get(
             constants.PLAYLIST_PREFIX,
@@ -219,6 +430,7 @@ def write_playlist(sp, playlist_info, results):
             playlist_info["prefix"].replace( "\"", "") + playlist_info["name"])
         song_ids = []
         old_song_ids = []
+        playlist_entry_ids = []
         if playlist_id is None:
             check_pysonic_connection().createPlaylist(
                 name=playlist_info["prefix"].replace( "\"", "") + playlist_info["name"], songIds=[])
@@ -229,7 +441,10 @@ def write_playlist(sp, playlist_info, results):
                 playlist_info["prefix"].replace( "\"", "") + playlist_info["name"])
             database.delete_playlist_relation_by_id(playlist_id)
         else:
-            old_song_ids = get_playlist_songs_ids_by_id(playlist_id)
+            playlist_entries = get_playlist_entry_ids_by_id(playlist_id)
+            playlist_entry_ids = playlist_entries[1]
+            old_song_ids = get_playlist_songs_ids_by_id(
+                playlist_id, playlist_entries=playlist_entries)
 
         if playlist_id is not None:
             pl_info_db = database.select_playlist_info_by_uuid(
@@ -241,21 +456,68 @@ def write_playlist(sp, playlist_info, results):
             else:
                 playlist_info["subsonic_playlist_id"] = playlist_id
                 track_helper = []
-                for track in results['tracks']:
-                    track = add_missing_values_to_track(sp, track)
+                flush_every = int(os.environ.get(
+                    constants.PLAYLIST_FLUSH_EVERY,
+                    constants.PLAYLIST_FLUSH_EVERY_DEFAULT_VALUE))
+                flushed_count = 0
+                tracks = enrich_tracks(sp, results['tracks'])
+                batch_candidates = get_batch_candidates(tracks)
+                artist_index = get_artist_index(playlist_info)
+                prior_matches = get_prior_matches(tracks)
+                library_version = library_helper.get_library_version(
+                    check_pysonic_connection())
+                negative_matches = get_negative_matches(
+                    tracks, library_version)
+                not_found_uris = []
+                indexed_isrcs = get_indexed_isrcs(tracks)
+                # the isrc index stage runs before any text search
+                skip_search = [
+                    batch_candidates[position] is not None
+                    or (track.get("uri") in prior_matches
+                        and prior_matches[track.get("uri")].fresh)
+                    or track.get("uri") in negative_matches
+                    or (track is not None and has_isrc(track)
+                        and track["external_ids"]["isrc"].strip().upper() in indexed_isrcs)
+                    for position, track in enumerate(tracks)]
+                prefetched_tracks = prefetch_tracks(
+                    sp, tracks, artist_index, skip_search)
+                for position, (track, search_results) in enumerate(prefetched_tracks):
                     found = False
+                    searched = False
+                    track_excluded = False
+                    searched_library = False
+                    negative = (track.get("uri") in negative_matches
+                                and track.get("uri") not in prior_matches)
+                    if negative:
+                        logging.info(
+                            '(%s) Track %s already searched in this library version, skipping search',
+                            str(threading.current_thread().ident),
+                            track.get('name'))
                     for artist_spotify in track['artists']:
                         if found is False:
-                            excluded = False
+                            excluded = track_excluded
                             if artist_spotify != '' and "name" in artist_spotify:
-                                logging.info(
-                                    '(%s) Searching %s - %s in your music library',
-                                    str(threading.current_thread().ident),
-                                    artist_spotify["name"],
-                                    track['name'])
-                                if "name" in track:
+                                # a single match pass checks all the credited artists
+                                if "name" in track and not negative and not searched:
+                                    searched = True
+                                    artist_names = get_track_artist_names(track)
+                                    logging.info(
+                                        '(%s) Searching %s - %s in your music library',
+                                        str(threading.current_thread().ident),
+                                        ", ".join(artist_names),
+                                        track['name'])
+                                    candidates = batch_candidates[position]
+                                    if (artist_index is not None and any(
+                                            len(artist_index.get_songs_by_artist(artist_name)) > 0
+                                            for artist_name in artist_names)):
+                                        candidates = artist_index.search(
+                                            artist_names, track['name'])
                                     comparison_helper = ComparisonHelper(
-                                        track, artist_spotify, found, excluded, song_ids, track_helper)
+                                        track, artist_spotify, found, excluded, song_ids, track_helper,
+                                        candidates=candidates,
+                                        prior_match=prior_matches.get(track.get("uri")),
+                                        search_results=search_results,
+                                        match_stats=match_stats)
                                     comparison_helper = match_with_subsonic_track(
                                         comparison_helper,
                                         playlist_info,
@@ -265,8 +527,10 @@ def write_playlist(sp, playlist_info, results):
                                     artist_spotify = comparison_helper.artist_spotify
                                     found = comparison_helper.found
                                     excluded = comparison_helper.excluded
+                                    searched_library = comparison_helper.searched_library
                                     song_ids = comparison_helper.song_ids
                                     track_helper = comparison_helper.track_helper
+                            track_excluded = track_excluded or excluded
                             if not excluded:
                                 if (os.environ.get(constants.SPOTDL_ENABLED,
                                                    constants.SPOTDL_ENABLED_DEFAULT_VALUE) == "1"
@@ -309,10 +573,21 @@ def write_playlist(sp, playlist_info, results):
                                         track['name'])
                                     insert_result = database.insert_song(
                                         playlist_info, None, artist_spotify, track)
-
+                    # misses against the artist discography or the batch
+                    # candidates say nothing about the whole library
+                    if (not negative and found is False and track_excluded is False
+                            and searched_library and track.get("uri") is not None):
+                        not_found_uris.append(track["uri"])
+                    if flush_every > 0 and len(song_ids) - flushed_count >= flush_every:
+                        playlist_entry_ids = flush_playlist(
+                            playlist_info, song_ids, playlist_entry_ids, remove=False)
+                        flushed_count = len(song_ids)
+
+                if library_version is not None and len(not_found_uris) > 0:
+                    database.insert_or_update_negative_matches(
+                        not_found_uris, library_version)
                 if len(song_ids) > 0:
-                    check_pysonic_connection().createPlaylist(
-                        playlistId=playlist_info["subsonic_playlist_id"], songIds=song_ids)
+                    flush_playlist(playlist_info, song_ids, playlist_entry_ids)
                     logging.info('(%s) Success! Created playlist %s', str(
                         threading.current_thread().ident), playlist_info["name"])
                 elif len(song_ids) == 0:
@@ -323,6 +598,11 @@ def write_playlist(sp, playlist_info, results):
                             threading.current_thread().ident), playlist_info["name"])
                     except DataNotFoundError:
                         pass
+                if "snapshot_id" in playlist_info:
+                    database.update_playlist_snapshot(
+                        playlist_info["uuid"],
+                        playlist_info["snapshot_id"],
+                        library_version)
 
     except SubsonicOfflineException:
         logging.error(
@@ -330,41 +610,499 @@ def write_playlist(sp, playlist_info, results):
             str(threading.current_thread().ident))
 
 
+def is_playlist_unchanged(playlist_info_db, snapshot_id):
+    """check if a playlist was already synced at this spotify snapshot
+    and with the current library version"""
+    if (snapshot_id is None
+            or playlist_info_db.snapshot_id != snapshot_id
+            or playlist_info_db.library_version is None):
+        return False
+    return library_helper.get_library_version(
+        check_pysonic_connection()) == playlist_info_db.library_version
+
+
+def get_artist_index(playlist_info):
+    """get the discography of the artist an artist playlist is built for"""
+    if (os.environ.get(constants.ARTIST_SCOPED_MATCHING,
+                       constants.ARTIST_SCOPED_MATCHING_DEFAULT_VALUE) != "1"
+            or "type" not in playlist_info
+            or playlist_info["type"] not in (constants.JOB_ATT_ID, constants.JOB_AR_ID)
+            or "import_arg" not in playlist_info
+            or playlist_info["import_arg"] is None):
+        return None
+    artist_index = library_helper.get_artist_index(
+        check_pysonic_connection(), playlist_info["import_arg"])
+    if artist_index is not None:
+        logging.info(
+            '(%s) Matching %s against %s songs of %s',
+            str(threading.current_thread().ident),
+            playlist_info["name"],
+            len(artist_index.songs),
+            playlist_info["import_arg"])
+    return artist_index
+
+
+def get_prior_matches(tracks):
+    """load the songs matched to these tracks by previous imports"""
+    spotify_uris = [track["uri"] for track in tracks
+                    if track is not None and "uri" in track and track["uri"] is not None]
+    return database.select_prior_matches(
+        spotify_uris,
+        int(os.environ.get(constants.PRIOR_MATCH_REVALIDATE_DAYS,
+                           constants.PRIOR_MATCH_REVALIDATE_DAYS_DEFAULT_VALUE)))
+
+
+def prefetch_tracks(sp, tracks, artist_index, skip_search):
+    """complete tracks and search the library for them in a bounded pool
+    of workers, yielding the results in playlist order; matching, dedupe
+    and database writes stay sequential in the caller"""
+    workers = int(os.environ.get(
+        constants.MATCHING_WORKERS,
+        constants.MATCHING_WORKERS_DEFAULT_VALUE))
+    if (os.environ.get(constants.MATCHING_BACKEND,
+                       constants.MATCHING_BACKEND_DEFAULT_VALUE) == "process"
+            and workers > 1
+            and is_library_index_enabled()
+            and library_helper.can_search_in_processes()):
+        yield from prefetch_tracks_in_processes(
+            sp, tracks, artist_index, skip_search, workers)
+    else:
+        yield from prefetch_tracks_in_threads(
+            sp, tracks, artist_index, skip_search, workers)
+
+
+def prefetch_tracks_in_threads(sp, tracks, artist_index, skip_search, workers):
+    """complete and search tracks in a thread pool, in playlist order"""
+    if workers <= 1:
+        for position, track in enumerate(tracks):
+            yield prefetch_track(sp, track, artist_index, skip_search[position])
+        return
+    memo = get_search_memo()
+
+    def prefetch(position):
+        with search_memo_scope(memo):
+            return prefetch_track(
+                sp, tracks[position], artist_index, skip_search[position])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(prefetch, range(len(tracks)))
+
+
+def prefetch_tracks_in_processes(sp, tracks, artist_index, skip_search, workers):
+    """complete tracks in threads, then shard the cpu bound library
+    search over worker processes"""
+    prefetched = list(prefetch_tracks_in_threads(
+        sp, tracks, artist_index, [True for track in tracks], workers))
+    positions = []
+    queries = []
+    for position, (track, search_results) in enumerate(prefetched):
+        artist_names = get_search_artist_names(track, artist_index)
+        if not skip_search[position] and artist_names is not None:
+            positions.append(position)
+            queries.append((artist_names, track['name']))
+    start = time.time()
+    results = library_helper.search_in_processes(queries, workers)
+    logging.info(
+        '(%s) Searched %s tracks in %s processes in %.1fs',
+        str(threading.current_thread().ident),
+        len(queries),
+        workers,
+        time.time() - start)
+    for position, search_results in zip(positions, results):
+        prefetched[position] = (prefetched[position][0], search_results)
+    yield from prefetched
+
+
+def prefetch_track(sp, track, artist_index, skip_search):
+    """complete a track and search the library for it"""
+    track = add_missing_values_to_track(sp, track)
+    search_results = None
+    artist_names = get_search_artist_names(track, artist_index)
+    if not skip_search and artist_names is not None:
+        search_results = get_library_search_results(
+            artist_names, track['name'])
+    return track, search_results
+
+
+def get_search_artist_names(track, artist_index):
+    """get the artists of a track if it needs a library search"""
+    if track is None or "name" not in track or "artists" not in track:
+        return None
+    artist_names = get_track_artist_names(track)
+    if len(artist_names) == 0 or (artist_index is not None and any(
+            len(artist_index.get_songs_by_artist(artist_name)) > 0
+            for artist_name in artist_names)):
+        return None
+    return artist_names
+
+
+def get_indexed_isrcs(tracks):
+    """get the isrcs of the tracks the isrc index has songs for"""
+    return database.select_indexed_isrcs(
+        [track["external_ids"]["isrc"] for track in tracks
+         if track is not None and has_isrc(track)])
+
+
+def get_negative_matches(tracks, library_version):
+    """get the tracks not found the last time this library version was searched"""
+    if library_version is None:
+        return set()
+    spotify_uris = [track["uri"] for track in tracks
+                    if track is not None and "uri" in track and track["uri"] is not None]
+    return database.select_negative_matches(
+        spotify_uris,
+        library_version,
+        int(os.environ.get(constants.NEGATIVE_MATCH_CACHE_TTL,
+                           constants.NEGATIVE_MATCH_CACHE_TTL_DEFAULT_VALUE)))
+
+
+def get_prior_match_song(comparison_helper):
+    """get the song of a recent previous match if it still exists,
+    older matches go through the match stages again"""
+    prior_match = comparison_helper.prior_match
+    if not prior_match.fresh:
+        return None
+    index = library_helper.get_library_index()
+    if index is not None:
+        # the library index is a free existence check
+        if prior_match.subsonic_song_id not in index.songs:
+            return None
+        return dict(index.songs[prior_match.subsonic_song_id])
+    return {"id": prior_match.subsonic_song_id,
+            "artistId": prior_match.subsonic_artist_id,
+            "artist": comparison_helper.artist_spotify["name"],
+            "title": comparison_helper.track['name'],
+            "album": get_album_name(comparison_helper.track)}
+
+
+def get_batch_candidates(tracks):
+    """score all tracks against the library at once,
+    return for each track its best library songs or None"""
+    index = library_helper.get_library_index()
+    if (os.environ.get(constants.BATCH_MATCHING_ENABLED,
+                       constants.BATCH_MATCHING_ENABLED_DEFAULT_VALUE) != "1"
+            or not is_library_index_enabled() or index is None):
+        return [None for track in tracks]
+    texts = []
+    for track in tracks:
+        text = track["name"] if track is not None and "name" in track else ""
+        if track is not None and "artists" in track:
+            text = " ".join([artist["name"] for artist in track["artists"]
+                             if "name" in artist]) + " " + text
+        texts.append(text)
+    start = time.time()
+    scores = scoring_helper.score_playlist(
+        index,
+        texts,
+        float(os.environ.get(constants.BATCH_MATCHING_MIN_SCORE,
+                             constants.BATCH_MATCHING_MIN_SCORE_DEFAULT_VALUE)))
+    logging.info(
+        '(%s) Scored %s tracks against the library in %.1fs',
+        str(threading.current_thread().ident),
+        len(tracks),
+        time.time() - start)
+    batch_candidates = []
+    for text, track_scores in zip(texts, scores):
+        candidates = None
+        if len(track_scores) > 0:
+            # candidates keep the score order, the fallback takes the first one
+            candidates = {}
+            for song_id, score in track_scores:
+                if song_id in index.songs:
+                    candidates[song_id] = dict(index.songs[song_id])
+                    logging.debug(
+                        '(%s) Batch candidate for %s: %s - %s, score %.2f',
+                        str(threading.current_thread().ident),
+                        text,
+                        index.songs[song_id]["artist"],
+                        index.songs[song_id]["title"],
+                        score)
+        batch_candidates.append(candidates)
+    return batch_candidates
+
+
+def flush_playlist(playlist_info, song_ids, playlist_entry_ids, remove=True):
+    """write the matched songs to the subsonic playlist, return its new entries"""
+    if os.environ.get(constants.PLAYLIST_SYNC_MODE,
+                      constants.PLAYLIST_SYNC_MODE_DEFAULT_VALUE) == "diff":
+        return sync_playlist(
+            playlist_info, song_ids, playlist_entry_ids, remove=remove)
+    return rewrite_playlist(playlist_info, song_ids)
+
+
+def rewrite_playlist(playlist_info, song_ids):
+    """replace the whole subsonic playlist"""
+    check_pysonic_connection().createPlaylist(
+        playlistId=playlist_info["subsonic_playlist_id"], songIds=song_ids)
+    logging.info(
+        '(%s) Written %s songs to playlist %s',
+        str(threading.current_thread().ident),
+        len(song_ids),
+        playlist_info["name"])
+    return list(song_ids)
+
+
+def sync_playlist(playlist_info, song_ids, playlist_entry_ids, remove=True):
+    """apply only the differences to the subsonic playlist via updatePlaylist"""
+    new_song_ids = set(song_ids)
+    kept_ids = []
+    kept_set = set()
+    indexes_to_remove = []
+    for entry_index, entry_id in enumerate(playlist_entry_ids):
+        if entry_id in kept_set or (remove and entry_id not in new_song_ids):
+            indexes_to_remove.append(entry_index)
+        else:
+            kept_ids.append(entry_id)
+            kept_set.add(entry_id)
+    ids_to_add = []
+    for song_id in song_ids:
+        if song_id not in kept_set:
+            ids_to_add.append(song_id)
+            kept_set.add(song_id)
+    if remove and list(dict.fromkeys(song_ids)) != kept_ids + ids_to_add:
+        # updatePlaylist can only append, so the songs would end up
+        # in a different order than the spotify one
+        return rewrite_playlist(playlist_info, song_ids)
+    if len(indexes_to_remove) == 0 and len(ids_to_add) == 0:
+        logging.info(
+            '(%s) Playlist %s is already up to date',
+            str(threading.current_thread().ident),
+            playlist_info["name"])
+        return kept_ids
+    # removing from the end first keeps the lower indexes valid between chunks
+    indexes_to_remove.reverse()
+    for chunk in range(0, len(indexes_to_remove), PLAYLIST_UPDATE_CHUNK_SIZE):
+        check_pysonic_connection().updatePlaylist(
+            playlist_info["subsonic_playlist_id"],
+            songIndexesToRemove=indexes_to_remove[chunk:chunk + PLAYLIST_UPDATE_CHUNK_SIZE])
+    for chunk in range(0, len(ids_to_add), PLAYLIST_UPDATE_CHUNK_SIZE):
+        check_pysonic_connection().updatePlaylist(
+            playlist_info["subsonic_playlist_id"],
+            songIdsToAdd=ids_to_add[chunk:chunk + PLAYLIST_UPDATE_CHUNK_SIZE])
+    logging.info(
+        '(%s) Synced playlist %s: %s songs added, %s removed',
+        str(threading.current_thread().ident),
+        playlist_info["name"],
+        len(ids_to_add),
+        len(indexes_to_remove))
+    return kept_ids + ids_to_add
+
+
 def match_with_subsonic_track(
         comparison_helper, playlist_info, old_song_ids):
-    """compare spotify track to subsonic one"""
-    text_to_search = comparison_helper.artist_spotify["name"] + \
-        " " + comparison_helper.track['name']
-    subsonic_search_results = get_subsonic_search_results(text_to_search)
-    skipped_songs = []
+    """compare spotify track to subsonic one, running the match stages
+    in order until one of them finds the song"""
+    for stage_name, stage in MATCH_STAGES:
+        start = time.time()
+        matched = stage(comparison_helper, playlist_info, old_song_ids)
+        record_match_stage(
+            comparison_helper.match_stats, stage_name, matched, time.time() - start)
+        if matched:
+            break
+    return comparison_helper
+
+
+def record_match_stage(match_stats, stage_name, matched, elapsed):
+    """count calls, hits and time spent by a match stage"""
+    if match_stats is None:
+        return
+    if stage_name not in match_stats:
+        match_stats[stage_name] = {"calls": 0, "hits": 0, "time": 0.0}
+    match_stats[stage_name]["calls"] = match_stats[stage_name]["calls"] + 1
+    match_stats[stage_name]["hits"] = match_stats[stage_name]["hits"] + \
+        (1 if matched else 0)
+    match_stats[stage_name]["time"] = match_stats[stage_name]["time"] + elapsed
+
+
+def format_match_stats(match_stats):
+    """format match stage stats for the run summary"""
+    return ", ".join(
+        '%s %s/%s hits in %.2fs' % (
+            stage_name,
+            match_stats[stage_name]["hits"],
+            match_stats[stage_name]["calls"],
+            match_stats[stage_name]["time"])
+        for stage_name, stage in MATCH_STAGES if stage_name in match_stats)
+
+
+def match_prior(comparison_helper, playlist_info, old_song_ids):
+    """reuse the song matched by a previous import"""
+    if (comparison_helper.prior_match is None
+            or comparison_helper.prior_match.subsonic_song_id in comparison_helper.song_ids):
+        return False
+    song = get_prior_match_song(comparison_helper)
+    if song is None or get_placeholder(song) in comparison_helper.track_helper:
+        return False
+    add_matched_song(
+        comparison_helper, playlist_info, song, "a previous import", verified=False)
+    return True
+
+
+def match_isrc_index(comparison_helper, playlist_info, old_song_ids):
+    """match the spotify isrc against the isrc index"""
+    if not has_isrc(comparison_helper.track):
+        return False
+    for song in get_isrc_index_songs(comparison_helper.track):
+        if song["id"] not in comparison_helper.song_ids:
+            add_isrc_match(comparison_helper, playlist_info, song)
+            return True
+    return False
+
+
+def match_retrieve(comparison_helper, playlist_info, old_song_ids):
+    """retrieve and prefilter candidates, the next stages match them"""
+    prefilter_candidates(comparison_helper, playlist_info, old_song_ids)
+    if len(comparison_helper.excluded_songs) > 0:
+        comparison_helper.excluded = True
+    return False
+
+
+def match_lazy_isrc(comparison_helper, playlist_info, old_song_ids):
+    """match by isrc, resolving isrc data only for the prefiltered songs"""
+    if not has_isrc(comparison_helper.track):
+        return False
+    for song in comparison_helper.matched_songs + comparison_helper.excluded_songs:
+        if song_has_isrc(song, comparison_helper.track["external_ids"]["isrc"]):
+            add_isrc_match(comparison_helper, playlist_info, song)
+            return True
+    return False
+
+
+def match_exact(comparison_helper, playlist_info, old_song_ids):
+    """match a prefiltered song with the same normalized artist, title and album"""
+    title_key = utils.get_compare_key(comparison_helper.track['name'])
+    for song in comparison_helper.matched_songs:
+        artist_key = utils.get_compare_key(
+            comparison_helper.song_artists[song["id"]]["name"])
+        if (utils.get_compare_key(song["artist"]) == artist_key
+                and utils.get_compare_key(song["title"]) == title_key
+                and is_album_matching(comparison_helper.track, song)
+                and get_placeholder(song) not in comparison_helper.track_helper):
+            add_matched_song(
+                comparison_helper, playlist_info, song, "exact comparison")
+            return True
+    return False
+
+
+def match_fuzzy(comparison_helper, playlist_info, old_song_ids):
+    """match the first prefiltered song on the same album"""
+    for song in comparison_helper.matched_songs:
+        if get_placeholder(song) not in comparison_helper.track_helper:
+            if is_album_matching(comparison_helper.track, song):
+                add_matched_song(
+                    comparison_helper, playlist_info, song, "text comparison")
+                return True
+            comparison_helper.skipped_songs.append(song)
+    return False
+
+
+def match_widen(comparison_helper, playlist_info, old_song_ids):
+    """search the regular lookup when no scoped candidate is on the same album,
+    the batch score and the artist discography ignore albums"""
+    if comparison_helper.candidates is None or comparison_helper.searched_library:
+        return False
+    matched_songs = comparison_helper.matched_songs
+    excluded_songs = comparison_helper.excluded_songs
+    comparison_helper.matched_songs = []
+    comparison_helper.excluded_songs = []
+    prefilter_library_songs(comparison_helper, playlist_info, old_song_ids)
+    matched = (match_lazy_isrc(comparison_helper, playlist_info, old_song_ids)
+               or match_exact(comparison_helper, playlist_info, old_song_ids)
+               or match_fuzzy(comparison_helper, playlist_info, old_song_ids))
+    if len(comparison_helper.excluded_songs) > 0:
+        comparison_helper.excluded = True
+    comparison_helper.matched_songs = matched_songs + comparison_helper.matched_songs
+    comparison_helper.excluded_songs = excluded_songs + comparison_helper.excluded_songs
+    return matched
+
+
+def match_fallback(comparison_helper, playlist_info, old_song_ids):
+    """use a prefiltered song from another album"""
+    if comparison_helper.excluded is True or len(comparison_helper.skipped_songs) == 0:
+        return False
+    if comparison_helper.candidates is not None:
+        # library index candidates are sorted by score
+        skipped_song = comparison_helper.skipped_songs[0]
+        chosen = "best scored"
+    else:
+        skipped_song = random.choice(comparison_helper.skipped_songs)
+        chosen = "random"
+    if get_placeholder(skipped_song) in comparison_helper.track_helper:
+        return False
+    logging.warning(
+        '(%s) No matching album found for Subsonic search "%s - %s", using the %s one',
+        str(threading.current_thread().ident),
+        comparison_helper.artist_spotify["name"],
+        comparison_helper.track['name'],
+        chosen)
+    add_matched_song(
+        comparison_helper, playlist_info, skipped_song, chosen + " match")
+    return True
+
+
+MATCH_STAGES = [
+    ("prior", match_prior),
+    ("isrc_index", match_isrc_index),
+    ("retrieve", match_retrieve),
+    ("lazy_isrc", match_lazy_isrc),
+    ("exact", match_exact),
+    ("fuzzy", match_fuzzy),
+    ("widen", match_widen),
+    ("fallback", match_fallback),
+]
+
+
+def prefilter_candidates(comparison_helper, playlist_info, old_song_ids):
+    """retrieve candidates and keep the songs matching artist and title"""
+    if comparison_helper.candidates is not None:
+        subsonic_search_results = comparison_helper.candidates
+    elif comparison_helper.search_results is not None:
+        subsonic_search_results = comparison_helper.search_results
+        comparison_helper.searched_library = True
+    else:
+        subsonic_search_results = get_library_search_results(
+            get_track_artist_names(comparison_helper.track),
+            comparison_helper.track['name'])
+        comparison_helper.searched_library = True
+    prefilter_songs(
+        comparison_helper, playlist_info, old_song_ids, subsonic_search_results)
+    if (comparison_helper.candidates is not None
+            and len(comparison_helper.matched_songs) == 0):
+        # none of the scoped candidates fits, try the regular lookup
+        prefilter_library_songs(comparison_helper, playlist_info, old_song_ids)
+
+
+def prefilter_library_songs(comparison_helper, playlist_info, old_song_ids):
+    """prefilter the regular lookup results, skipping the scoped candidates"""
+    if comparison_helper.search_results is not None:
+        subsonic_search_results = comparison_helper.search_results
+    else:
+        subsonic_search_results = get_library_search_results(
+            get_track_artist_names(comparison_helper.track),
+            comparison_helper.track['name'])
+    comparison_helper.searched_library = True
+    prefilter_songs(
+        comparison_helper,
+        playlist_info,
+        old_song_ids,
+        {song_id: song for song_id, song in subsonic_search_results.items()
+         if song_id not in comparison_helper.candidates})
+
+
+def prefilter_songs(comparison_helper, playlist_info, old_song_ids, subsonic_search_results):
+    """keep the songs matching artist and title"""
+    # the artist processed by the caller is checked first
+    artists_spotify = [comparison_helper.artist_spotify] + [
+        artist_spotify for artist_spotify in comparison_helper.track['artists']
+        if artist_spotify != '' and "name" in artist_spotify
+        and artist_spotify is not comparison_helper.artist_spotify]
     for song_id in subsonic_search_results:
         song = subsonic_search_results[song_id]
-        song["isrc-list"] = musicbrainz_helper.get_isrc_by_id(song)
-        placeholder = song["artist"] + " " + \
-            song["title"] + " " + song["album"]
-        if song["id"] in old_song_ids:
-            logging.info(
-                '(%s) Track with id "%s" already in playlist "%s"',
-                str(threading.current_thread().ident),
-                song["id"],
-                playlist_info["name"])
-            comparison_helper.song_ids.append(song["id"])
-            comparison_helper.found = True
-            insert_result = database.insert_song(
-                playlist_info,
-                song,
-                comparison_helper.artist_spotify,
-                comparison_helper.track)
-        elif (song["id"] not in comparison_helper.song_ids
+        if (song["id"] not in comparison_helper.song_ids
               and song["artist"] != ''
               and comparison_helper.track['name'] != ''
               and song["album"] != ''
               and song["title"] != ''):
-            album_name = ""
-            if ("album" in comparison_helper.track
-                and "name" in comparison_helper.track["album"]
-                    and comparison_helper.track["album"]["name"] is not None):
-                album_name = comparison_helper.track["album"]["name"]
             logging.info(
                 '(%s) Comparing song "%s - %s - %s" with Spotify track "%s - %s - %s"',
                 str(threading.current_thread().ident),
@@ -373,105 +1111,136 @@ def match_with_subsonic_track(
                 song["album"],
                 comparison_helper.artist_spotify["name"],
                 comparison_helper.track['name'],
-                album_name)
-            if has_isrc(comparison_helper.track):
-                found_isrc = False
-                for isrc in song["isrc-list"]:
-                    if isrc.strip(
-                    ) == comparison_helper.track["external_ids"]["isrc"].strip():
-                        found_isrc = True
+                get_album_name(comparison_helper.track))
+            if utils.compare_strings(comparison_helper.track['name'], song["title"]):
+                for artist_spotify in artists_spotify:
+                    if utils.compare_strings(artist_spotify["name"], song["artist"]):
+                        # only songs matching artist and title may need
+                        # a musicbrainz isrc lookup, excluded or not
+                        if library_helper.is_song_excluded(song):
+                            logging.warning(
+                                '(%s) Song "%s - %s" contains an excluded word. Skipping...',
+                                str(threading.current_thread().ident),
+                                song["title"],
+                                song["album"])
+                            comparison_helper.excluded_songs.append(song)
+                        else:
+                            comparison_helper.song_artists[song["id"]] = artist_spotify
+                            comparison_helper.matched_songs.append(song)
                         break
-                if found_isrc is True:
-                    comparison_helper.track_helper.append(placeholder)
-                    comparison_helper.found = True
-                    insert_result = database.insert_song(
-                        playlist_info, song, comparison_helper.artist_spotify, comparison_helper.track)
-                    is_ignored = check_ignored(
-                        insert_result, song, playlist_info)
-                    if is_ignored is False:
-                        comparison_helper.song_ids.append(song["id"])
-                        logging.info(
-                            '(%s) Adding song "%s - %s - %s" to playlist "%s", matched by ISRC: "%s"',
-                            str(threading.current_thread().ident),
-                            song["artist"],
-                            song["title"],
-                            song["album"],
-                            playlist_info["name"],
-                            comparison_helper.track["external_ids"]["isrc"])
-                        check_pysonic_connection().createPlaylist(
-                            playlistId=playlist_info["subsonic_playlist_id"],
-                            songIds=comparison_helper.song_ids)
-                    break
-            if (utils.compare_string_to_exclusion(song["title"],
-                utils.get_excluded_words_array())
-                or utils.compare_string_to_exclusion(song["album"],
-                                                     utils.get_excluded_words_array())):
-                comparison_helper.excluded = True
-            elif (utils.compare_strings(comparison_helper.artist_spotify["name"], song["artist"])
-                  and utils.compare_strings(comparison_helper.track['name'], song["title"])
-                  and placeholder not in comparison_helper.track_helper):
-                if (
-                    (
-                        "album" in comparison_helper.track and "name" in comparison_helper.track["album"] and utils.compare_strings(
-                            comparison_helper.track['album']['name'],
-                            song["album"])) or (
-                        "album" not in comparison_helper.track) or (
-                        "album" in comparison_helper.track and "name" not in comparison_helper.track["album"])):
-                    comparison_helper.track_helper.append(placeholder)
-                    comparison_helper.found = True
-                    insert_result = database.insert_song(
-                        playlist_info, song, comparison_helper.artist_spotify, comparison_helper.track)
-                    is_ignored = check_ignored(
-                        insert_result, song, playlist_info)
-                    if is_ignored is False:
-                        comparison_helper.song_ids.append(song["id"])
-                        logging.info(
-                            '(%s) Adding song "%s - %s - %s" to playlist "%s", matched by text comparison',
-                            str(threading.current_thread().ident),
-                            song["artist"],
-                            song["title"],
-                            song["album"],
-                            playlist_info["name"])
-                        check_pysonic_connection().createPlaylist(
-                            playlistId=playlist_info["subsonic_playlist_id"],
-                            songIds=comparison_helper.song_ids)
-                    break
-                skipped_songs.append(song)
-    if comparison_helper.found is False and comparison_helper.excluded is False and len(
-            skipped_songs) > 0:
-        skipped_song = random.choice(skipped_songs)
-        placeholder = skipped_song["artist"] + " " + \
-            skipped_song['title'] + " " + skipped_song["album"]
-        if placeholder not in comparison_helper.track_helper:
-
-            comparison_helper.found = True
-            comparison_helper.track_helper.append(placeholder)
-            insert_result = database.insert_song(
-                playlist_info,
-                skipped_song,
-                comparison_helper.artist_spotify,
-                comparison_helper.track)
-
-            is_ignored = check_ignored(
-                insert_result, skipped_song, playlist_info)
-
-            if is_ignored is False:
-                comparison_helper.song_ids.append(skipped_song["id"])
+    # songs already in the playlist go first, so a new search keeps them
+    comparison_helper.matched_songs.sort(key=lambda song: song["id"] not in old_song_ids)
+
+
+def get_placeholder(song):
+    """get the key used to add a library song only once per playlist"""
+    return song["artist"] + " " + song["title"] + " " + song["album"]
+
+
+def get_album_name(track):
+    """get spotify track album name, empty if missing"""
+    if ("album" in track and "name" in track["album"]
+            and track["album"]["name"] is not None):
+        return track["album"]["name"]
+    return ""
+
+
+def is_album_matching(track, song):
+    """check song album against the spotify one, if the track has one"""
+    if "album" not in track or "name" not in track["album"]:
+        return True
+    return utils.compare_strings(track['album']['name'], song["album"])
+
+
+def add_isrc_match(comparison_helper, playlist_info, song):
+    """add a song matched by isrc to the playlist"""
+    add_matched_song(
+        comparison_helper,
+        playlist_info,
+        song,
+        'ISRC: "' + comparison_helper.track["external_ids"]["isrc"] + '"')
+
+
+def add_matched_song(comparison_helper, playlist_info, song, matched_by, verified=True):
+    """add a matched song to the playlist, verified is False when
+    the song comes from a previous match"""
+    if song["id"] in comparison_helper.song_artists:
+        comparison_helper.artist_spotify = comparison_helper.song_artists[song["id"]]
+    comparison_helper.track_helper.append(get_placeholder(song))
+    comparison_helper.found = True
+    insert_result = database.insert_song(
+        playlist_info, song, comparison_helper.artist_spotify, comparison_helper.track,
+        verified=verified)
+    is_ignored = check_ignored(
+        insert_result, song, playlist_info)
+    if is_ignored is False:
+        comparison_helper.song_ids.append(song["id"])
+        logging.info(
+            '(%s) Adding song "%s - %s - %s" to playlist "%s", matched by %s',
+            str(threading.current_thread().ident),
+            song["artist"],
+            song["title"],
+            song["album"],
+            playlist_info["name"],
+            matched_by)
+
+
+def song_has_isrc(song, isrc):
+    """check song isrc, calling musicbrainz only when subsonic has none"""
+    isrc = isrc.strip().upper()
+    isrcs = get_song_isrcs(song)
+    if len(isrcs) == 0:
+        isrcs = musicbrainz_helper.get_isrc_by_id(song)
+        add_to_isrc_index(song, isrcs)
+    for song_isrc in isrcs:
+        if song_isrc.strip().upper() == isrc:
+            return True
+    return False
 
-                logging.warning(
-                    '(%s) No matching album found for Subsonic search "%s", using a random one', str(
-                        threading.current_thread().ident), text_to_search)
-                logging.info(
-                    '(%s) Adding song "%s - %s - %s" to playlist "%s", random match',
-                    str(threading.current_thread().ident),
-                    skipped_song["artist"],
-                    song["title"],
-                    skipped_song["album"],
-                    playlist_info["name"])
-                check_pysonic_connection().createPlaylist(
-                    playlistId=playlist_info["subsonic_playlist_id"],
-                    songIds=comparison_helper.song_ids)
-    return comparison_helper
+
+def get_song_by_id(song_id):
+    """get subsonic song from the library index or from subsonic"""
+    index = library_helper.get_library_index()
+    if index is not None and song_id in index.songs:
+        return dict(index.songs[song_id])
+    try:
+        song_search = check_pysonic_connection().getSong(song_id)
+    except DataNotFoundError:
+        return None
+    if "song" in song_search:
+        return song_search["song"]
+    return None
+
+
+def get_isrc_index_songs(track):
+    """get subsonic songs matching the spotify track isrc"""
+    songs = []
+    for song_id in database.select_subsonic_song_ids_by_isrc(
+            track["external_ids"]["isrc"]):
+        song = get_song_by_id(song_id)
+        if song is None:
+            database.delete_isrc_by_subsonic_song_id(song_id)
+        elif ("artist" in song and "title" in song and "album" in song):
+            songs.append(song)
+    return songs
+
+
+def get_song_isrcs(song):
+    """get isrcs reported by subsonic for a song"""
+    if "isrc" not in song or song["isrc"] is None:
+        return []
+    if isinstance(song["isrc"], str):
+        return [song["isrc"]] if song["isrc"].strip() != "" else []
+    return [isrc for isrc in song["isrc"] if isrc is not None and isrc.strip() != ""]
+
+
+def add_to_isrc_index(song, isrcs):
+    """store isrcs of a subsonic song in the isrc index"""
+    if len(isrcs) > 0:
+        musicbrainz_id = song["musicBrainzId"] if "musicBrainzId" in song else None
+        database.insert_isrcs([{"isrc": isrc,
+                                "subsonic_song_id": song["id"],
+                                "musicbrainz_id": musicbrainz_id} for isrc in isrcs])
 
 
 def check_ignored(insert_result, song, playlist_info):
@@ -578,6 +1347,18 @@ def select_all_playlists(spotipy_helper, page=None,
 
         has_been_deleted = False
 
+        artist_uris = [playlist["spotify_playlist_uri"] for playlist in all_playlists
+                       if playlist["type"] in (constants.JOB_ATT_ID, constants.JOB_AR_ID)
+                       and playlist["spotify_playlist_uri"]]
+        # the page must not wait for spotify, misses are batch loaded in background
+        cached_artists = database.select_spotify_objects(artist_uris)
+        missing_artist_uris = [uri for uri in artist_uris if uri not in cached_artists]
+        if len(missing_artist_uris) > 0:
+            cache_executor.submit(
+                load_spotify_objects_to_cache,
+                spotipy_helper.get_spotipy_client(),
+                missing_artist_uris)
+
         songs = []
 
         ids = []
@@ -588,8 +1369,10 @@ def select_all_playlists(spotipy_helper, page=None,
                     "subsonic_playlist_id"] is not None and playlist["subsonic_playlist_id"] not in ids:
                 ids.append(playlist["subsonic_playlist_id"])
             if playlist["type"] == constants.JOB_ATT_ID or playlist["type"] == constants.JOB_AR_ID:
-                spotify_artist = get_spotify_object_from_cache(
-                    spotipy_helper.get_spotipy_client(), playlist["spotify_playlist_uri"])
+                spotify_artist = None
+                if playlist["spotify_playlist_uri"] in cached_artists:
+                    spotify_artist = json.loads(
+                        cached_artists[playlist["spotify_playlist_uri"]])
                 if spotify_artist is not None and "images" in spotify_artist and spotify_artist["images"] is not None and len(
                         spotify_artist["images"]) > 0:
                     playlist["image"] = spotify_artist["images"][0]["url"]
@@ -634,9 +1417,9 @@ def get_playlist_from_cache(key):
     return playlist_cache[key], has_been_deleted
 
 
-def get_playlist_songs_ids_by_id(key):
-    """get playlist songs ids by id"""
-    songs = []
+def get_playlist_entry_ids_by_id(key):
+    """get playlist name and ordered ids of all its entries"""
+    entry_ids = []
     playlist_search = None
     try:
         playlist_search = check_pysonic_connection().getPlaylist(key)
@@ -653,18 +1436,24 @@ def get_playlist_songs_ids_by_id(key):
             '(%s) Deleting Playlist with id "%s" from spotisub database.',
             str(threading.current_thread().ident), key)
         database.delete_playlist_relation_by_id(key)
-    elif (playlist_search is not None
-            and "playlist" in playlist_search
-            and "entry" in playlist_search["playlist"]
-            and len(playlist_search["playlist"]["entry"]) > 0):
-        songs = playlist_search["playlist"]["entry"]
+        return None, entry_ids
+    if ("playlist" in playlist_search
+            and "entry" in playlist_search["playlist"]):
         for entry in playlist_search["playlist"]["entry"]:
-            if "id" in entry and entry["id"] is not None and entry["id"].strip(
-            ) != "":
-                if not is_ignored(
-                        entry["id"],
-                        playlist_search["playlist"]["name"]):
-                    songs.append(entry["id"])
+            if "id" in entry and entry["id"] is not None:
+                entry_ids.append(entry["id"])
+    return playlist_search["playlist"]["name"], entry_ids
+
+
+def get_playlist_songs_ids_by_id(key, playlist_entries=None):
+    """get playlist songs ids by id"""
+    songs = []
+    if playlist_entries is None:
+        playlist_entries = get_playlist_entry_ids_by_id(key)
+    playlist_name, entry_ids = playlist_entries
+    for entry_id in entry_ids:
+        if entry_id.strip() != "" and not is_ignored(entry_id, playlist_name):
+            songs.append(entry_id)
 
     return songs
 
@@ -859,4 +1648,5 @@ def set_ignore(type, uuid, value):
         database.update_ignored_playlist(uuid, value)
 
 
-spotify_cache = load_spotify_cache_from_file()
+remove_spotify_cache_file()
+database.delete_expired_spotify_objects()
@@ -644,3 +644,13 @@ class Healthcheck(Resource):
     def get(self):
         """Healthcheck endpoint"""
         return "Ok!"
+
+
+@nsutils.route('/spotify_metrics')
+class SpotifyMetrics(Resource):
+    """Spotify metrics class"""
+
+    def get(self):
+        """Spotify api rate usage and throttling endpoint"""
+        return get_response_json(
+            json.dumps(spotipy_helper.get_rate_limit_metrics()), 200)
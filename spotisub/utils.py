@@ -1,6 +1,7 @@
 """Spotisub utils module"""
 import os
 import re
+import functools
 import sys
 import logging
 import threading
@@ -39,52 +40,76 @@ def write_exception():
         exc_info=1)
 
 
-def generate_compare_array(strings):
-    """generate compare array"""
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+COMPARE_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=COMPARE_CACHE_SIZE)
+def get_compare_variants(strings):
+    """get normalized compare variants, memoized"""
     strings = strings.strip().lower()
-    compare_array_values = []
-    compare_array_values.append(strings)
-    compare_array_values.append(re.sub(r'[^\w\s]', '', strings).strip())
+    compare_array_values = set()
+    compare_array_values.add(strings)
+    compare_array_values.add(PUNCTUATION_PATTERN.sub('', strings).strip())
     for token in constants.SPLIT_TOKENS:
-        compare_array_values.append(strings.split(token, 1)[0].strip())
-        compare_array_values.append(
-            re.sub(
-                r'[^\w\s]',
-                '',
-                strings.split(
-                    token,
-                    1)[0]).strip())
+        split_value = strings.split(token, 1)[0]
+        compare_array_values.add(split_value.strip())
+        compare_array_values.add(
+            PUNCTUATION_PATTERN.sub('', split_value).strip())
 
-    return list(set(compare_array_values))
+    return tuple(compare_array_values)
 
 
-def compare_strings(a, b):
-    """compare strings"""
-    return compare(generate_compare_array(a), generate_compare_array(b))
+@functools.lru_cache(maxsize=COMPARE_CACHE_SIZE)
+def get_compare_tokens(strings):
+    """get normalized words of a string, memoized"""
+    return frozenset(PUNCTUATION_PATTERN.sub(' ', strings.lower()).split())
 
 
-def compare_string_to_exclusion(a, stringb):
-    """compare string to exclusion"""
-    if a is not None and a.strip() != '':
-        words_no_punctuation = []
-        for word in a.split():
-            words_no_punctuation.append(
-                re.sub(r'[^\w\s]', '', word).strip().lower())
-    return compare_exact_word(list(set(words_no_punctuation)), stringb)
+@functools.lru_cache(maxsize=COMPARE_CACHE_SIZE)
+def get_compare_key(strings):
+    """get the exact normalized form of a string, memoized"""
+    return " ".join(PUNCTUATION_PATTERN.sub(' ', strings.lower()).split())
 
 
-def compare_exact_word(stringsa, stringsb):
-    """compare exact word"""
-    for stringa in stringsa:
-        for stringb in stringsb:
-            if stringa != '' and stringb != '' and stringa == stringb:
-                logging.warning(
-                    "(%s) Found excluded word: %s. Skipping...",
-                    str(threading.current_thread().ident), stringb)
-                return True
+def generate_compare_array(strings):
+    """generate compare array"""
+    return list(get_compare_variants(strings))
+
+
+@functools.lru_cache(maxsize=COMPARE_CACHE_SIZE)
+def get_search_plan(strings):
+    """get compare variants as search queries, ordered from broad to narrow"""
+    queries = [variant for variant in get_compare_variants(strings) if variant != '']
+    return tuple(sorted(queries, key=lambda query: (len(query.split()), len(query), query)))
+
+
+def is_covered_by(query, broader_queries):
+    """check if a query can only return a subset of an already searched query"""
+    words = set(query.split())
+    for broader_query in broader_queries:
+        if set(broader_query.split()).issubset(words):
+            return True
     return False
 
 
+def compare_strings(a, b):
+    """compare strings"""
+    return compare(get_compare_variants(a), get_compare_variants(b))
+
+
+def is_excluded(value):
+    """check if a string contains one of the excluded words"""
+    if EXCLUDED_WORDS_PATTERN is None or value is None or value.strip() == '':
+        return False
+    normalized = PUNCTUATION_PATTERN.sub('', value.lower())
+    tokens = normalized.split()
+    if len(tokens) == 1:
+        # single word titles need no regex
+        return tokens[0] in EXCLUDED_WORDS_SET
+    return EXCLUDED_WORDS_PATTERN.search(normalized) is not None
+
+
 def compare(stringsa, stringsb, log_excluded=False):
     """compare two arrays"""
     for stringa in stringsa:
@@ -112,6 +137,22 @@ def get_excluded_words_array():
     return excluded_words
 
 
+def compile_excluded_words():
+    """compile excluded words into a set and a single whole word regex"""
+    words = frozenset(word.strip().lower() for word in get_excluded_words_array()
+                      if word.strip() != '')
+    if len(words) == 0:
+        return words, None
+    # words are matched after punctuation removal, as whitespace separated tokens
+    pattern = re.compile(
+        r'(?<!\S)(?:' + '|'.join(re.escape(word) for word in
+                                 sorted(words, key=len, reverse=True)) + r')(?!\S)')
+    return words, pattern
+
+
+EXCLUDED_WORDS_SET, EXCLUDED_WORDS_PATTERN = compile_excluded_words()
+
+
 def get_pagination(page, total_pages):
     value = []
     value.append(page)